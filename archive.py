@@ -0,0 +1,172 @@
+import logging
+import os
+import queue
+import struct
+import time
+from threading import Thread
+
+LOG = logging.getLogger('Zellostream.archive')
+
+PRE_SKIP = 312  # libopus encoder lookahead at 48 kHz
+PACKETS_PER_PAGE = 50  # about 3 seconds of 60 ms packets
+BATCH_SECONDS = 1  # how often the writer thread wakes up to write what has been queued
+
+
+def _crc_table():
+	table = []
+	for i in range(256):
+		crc = i << 24
+		for _ in range(8):
+			crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+		table.append(crc & 0xFFFFFFFF)
+	return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def ogg_crc(data):
+	crc = 0
+	for byte in data:
+		crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[(crc >> 24) ^ byte]
+	return crc
+
+
+class OggOpusWriter:
+	"""Writes already encoded Opus packets into an Ogg Opus file (RFC 7845), one logical stream."""
+
+	def __init__(self, f, serial, sample_rate, packet_samples, comments):
+		self.f = f
+		self.serial = serial
+		self.packet_samples = packet_samples  # per packet, at 48 kHz as the granule position counts
+		self.sequence = 0
+		self.granule = 0
+		self._packets = []
+		self._segments = 0
+		head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, PRE_SKIP, sample_rate, 0, 0)
+		self._write_page([head], 0, bos=True)
+		vendor = b"zellostream"
+		tags = b"OpusTags" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(comments))
+		for name, value in comments.items():
+			comment = f"{name}={value}".encode("utf-8")
+			tags += struct.pack("<I", len(comment)) + comment
+		self._write_page([tags], 0)
+
+	def write(self, packet):
+		segments = len(packet) // 255 + 1
+		if self._segments + segments > 255:  # a page holds at most 255 lacing values
+			self._write_page(self._packets, self.granule)
+			self._packets = []
+			self._segments = 0
+		self._packets.append(packet)
+		self._segments += segments
+		self.granule += self.packet_samples
+		if len(self._packets) >= PACKETS_PER_PAGE:
+			self._write_page(self._packets, self.granule)
+			self._packets = []
+			self._segments = 0
+
+	def close(self):
+		# the last page carries the end of stream flag, even when it has no packets left to hold
+		self._write_page(self._packets, self.granule, eos=True)
+		self._packets = []
+		self.f.close()
+
+	def _write_page(self, packets, granule, bos=False, eos=False):
+		lacing = bytearray()
+		for packet in packets:
+			lacing.extend(b"\xff" * (len(packet) // 255))
+			lacing.append(len(packet) % 255)
+		header_type = (2 if bos else 0) | (4 if eos else 0)
+		header = struct.pack("<4sBBqIIIB", b"OggS", 0, header_type, granule, self.serial, self.sequence, 0, len(lacing)) + lacing
+		page = bytearray(header)
+		for packet in packets:
+			page.extend(packet)
+		struct.pack_into("<I", page, 22, ogg_crc(page))
+		self.f.write(page)
+		self.sequence += 1
+
+
+class Archiver:
+	"""Records Opus packets to one Ogg Opus file per Zello stream without transcoding.
+
+	start(), packet() and stop() only queue work, so they are safe to call
+	from the audio loop; a writer thread wakes up every BATCH_SECONDS and
+	writes everything queued since, so the files are touched about once a
+	second however many packets there are.
+	"""
+
+	def __init__(self, directory):
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+		self._queue = queue.SimpleQueue()
+		self._next_id = 1
+		self._thread = Thread(target=self._run, name="archive", daemon=True)
+		self._thread.start()
+
+	def start(self, direction, channel, stream_id, packet_duration, sample_rate, tgid=None, sender=None):
+		"""Begin a recording and return its handle for packet() and stop()."""
+		handle = self._next_id
+		self._next_id += 1
+		started = time.time()
+		stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+		name = "_".join(str(part) for part in (stamp, direction, channel, tgid, stream_id) if part is not None)
+		comments = {
+			"DATE": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(started)),
+			"DIRECTION": direction,
+			"CHANNEL": channel,
+			"STREAM_ID": stream_id,
+		}
+		if tgid is not None:
+			comments["TGID"] = tgid
+		if sender:
+			comments["FROM"] = sender
+		filename = os.path.join(self.directory, "".join(c if c.isalnum() or c in "-_." else "_" for c in name) + ".opus")
+		self._queue.put(("start", handle, (filename, sample_rate, packet_duration * 48, comments)))
+		return handle
+
+	def packet(self, handle, packet):
+		self._queue.put(("packet", handle, bytes(packet)))
+
+	def stop(self, handle):
+		self._queue.put(("stop", handle, None))
+
+	def close(self):
+		self._queue.put(("close", None, None))
+		self._thread.join()
+
+	def _run(self):
+		writers = {}
+		running = True
+		while running:
+			items = [self._queue.get()]
+			time.sleep(BATCH_SECONDS)
+			while True:
+				try:
+					items.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			for op, handle, data in items:
+				try:
+					if op == "packet":
+						writer = writers.get(handle)
+						if writer:
+							writer.write(data)
+					elif op == "start":
+						filename, sample_rate, packet_samples, comments = data
+						f = open(filename, "wb", buffering=1 << 16)
+						writers[handle] = OggOpusWriter(f, handle, sample_rate, packet_samples, comments)
+						LOG.info("recording to %s", filename)
+					elif op == "stop":
+						writer = writers.pop(handle, None)
+						if writer:
+							writer.close()
+					elif op == "close":
+						running = False
+				except OSError as ex:
+					LOG.error("archive write error: %s", ex)
+					writers.pop(handle, None)
+			for writer in writers.values():
+				writer.f.flush()
+		for writer in writers.values():
+			writer.close()
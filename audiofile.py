@@ -0,0 +1,109 @@
+import glob
+import logging
+import os
+import struct
+import numpy as np
+
+LOG = logging.getLogger('Zellostream.audiofile')
+
+BLOCK_BYTES = 1 << 20  # audio is handed on in pieces of this size, not a frame at a time
+PLAYLIST_EXTENSIONS = (".m3u", ".m3u8", ".txt")
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def playlist(entries):
+	"""Expand file names, glob patterns and playlist files (one name per line) into the files to play, in order."""
+	if isinstance(entries, str):
+		entries = [entries]
+	files = []
+	for entry in entries:
+		if entry.lower().endswith(PLAYLIST_EXTENSIONS):
+			directory = os.path.dirname(entry)
+			with open(entry, encoding="utf-8") as f:
+				lines = [line.strip() for line in f]
+			files.extend(playlist([os.path.join(directory, line) for line in lines if line and not line.startswith("#")]))
+		elif glob.has_magic(entry):
+			files.extend(sorted(glob.glob(entry)))
+		else:
+			files.append(entry)
+	return files
+
+
+def wav_format(f):
+	"""Return (sample_rate, channels, bits, data offset, data length) of a WAV file, or None if it is not one."""
+	riff = f.read(12)
+	if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+		return None
+	sample_rate = channels = bits = None
+	while True:
+		header = f.read(8)
+		if len(header) < 8:
+			return None
+		chunk, length = struct.unpack("<4sI", header)
+		if chunk == b"fmt ":
+			fmt = f.read(length)
+			tag, channels, sample_rate = struct.unpack_from("<HHI", fmt)
+			bits = struct.unpack_from("<H", fmt, 14)[0]
+			if tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE):
+				raise ValueError(f"WAV encoding {tag} is not PCM")
+		elif chunk == b"data":
+			if sample_rate is None:
+				return None
+			offset = f.tell()
+			return sample_rate, channels, bits, offset, min(length, os.fstat(f.fileno()).st_size - offset)
+		else:
+			f.seek(length + length % 2, os.SEEK_CUR)  # chunks are padded to an even length
+
+
+def open_audio(path, sample_rate, channels):
+	"""Map a WAV or raw int16 file into memory as an array of samples.
+
+	Raw files are taken to be at sample_rate with channels interleaved; a
+	WAV file must be 16 bit PCM in that format too.
+	"""
+	with open(path, "rb") as f:
+		wav = wav_format(f)
+		if wav:
+			file_rate, file_channels, bits, offset, length = wav
+			if (file_rate, file_channels, bits) != (sample_rate, channels, 16):
+				raise ValueError(f"{file_rate} Hz {file_channels} channel {bits} bit audio, expected {sample_rate} Hz {channels} channel 16 bit")
+		else:
+			offset = 0
+			length = os.fstat(f.fileno()).st_size
+	if length < 2:
+		return np.zeros(0, dtype=np.int16)
+	return np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(length // 2,))
+
+
+def file_blocks(paths, sample_rate, channels, block_bytes=BLOCK_BYTES):
+	"""Yield the samples of each file in turn, in blocks of block_bytes; files that cannot be played are skipped."""
+	for path in paths:
+		try:
+			samples = open_audio(path, sample_rate, channels)
+		except (OSError, ValueError) as ex:
+			LOG.error("cannot play %s: %s", path, ex)
+			continue
+		LOG.info("playing %s", path)
+		for start in range(0, len(samples), block_bytes // 2):
+			yield samples[start:start + block_bytes // 2]
+
+
+def stream_blocks(stream, block_bytes=BLOCK_BYTES):
+	"""Yield samples from a raw int16 byte stream, such as stdin, as they come in up to block_bytes at a time.
+
+	Each block is a view of one reused buffer, valid until the next one is asked for.
+	"""
+	buffer = bytearray(block_bytes)
+	view = memoryview(buffer)
+	kept = 0  # odd byte left over from the last read
+	while True:
+		count = stream.readinto(view[kept:])
+		if not count:
+			return
+		count += kept
+		usable = count - count % 2
+		yield np.frombuffer(buffer, dtype=np.int16, count=usable // 2)
+		kept = count - usable
+		if kept:
+			buffer[0] = buffer[usable]
@@ -0,0 +1,439 @@
+"""Micro-benchmarks for the zellostream audio path.
+
+Run with: python benchmark.py [name ...]
+With no names every benchmark is run.  Results are printed as CPU time
+per 60 ms frame so they can be compared directly with the frame budget.
+The e2e-* benchmarks run the whole bridge against the local fake Zello
+server (fakezello.py) with synthetic UDP, sound card and Zello audio, so
+they need neither network access nor audio hardware.
+Checks that have a budget (startup) make the script exit with status 1
+when they exceed it, so it can be used as a regression test.
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+try:
+	import resource
+except ImportError:  # Windows
+	resource = None
+
+from resampler import StreamResampler
+
+FRAME_SECONDS = 0.06
+STARTUP_BUDGET = float(os.environ.get("ZELLOSTREAM_STARTUP_BUDGET", 1.0))  # seconds
+LAZY_MODULES = ("pyaudio", "pulsectl", "Crypto", "librosa")
+E2E_SECONDS = float(os.environ.get("ZELLOSTREAM_E2E_SECONDS", 5))
+E2E_CONFIG = {
+	"username": "bench",
+	"password": "bench",
+	"zello_channel": "bench",
+	"zello_work_account_name": "bench",
+	"vox_silence_time": 0.5,
+	"audio_threshold": 1000,
+	"vox_preroll": 0,  # so packets line up one to one with the frames fed in
+	"logging_level": "warning",
+}
+
+
+def cpu_us_per_frame(func, frames, repeat=3):
+	best = None
+	for _ in range(repeat):
+		start = time.process_time()
+		for frame in frames:
+			func(frame)
+		elapsed = time.process_time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best / len(frames) * 1e6
+
+
+def synthetic_frames(sample_rate, seconds=10, amplitude=8000):
+	chunk = int(sample_rate * FRAME_SECONDS)
+	t = np.arange(int(sample_rate * seconds)) / sample_rate
+	signal = amplitude * np.sin(2 * np.pi * 440 * t) + amplitude / 4 * np.random.default_rng(0).standard_normal(len(t))
+	signal = np.clip(signal, -32768, 32767).astype(np.int16)
+	return [signal[i:i + chunk] for i in range(0, len(signal) - chunk + 1, chunk)]
+
+
+def bench_resample():
+	try:
+		import librosa
+	except ImportError:
+		librosa = None
+	for orig_sr, target_sr in ((48000, 16000), (8000, 16000), (16000, 48000), (44100, 16000)):
+		frames = synthetic_frames(orig_sr)
+		resampler = StreamResampler(orig_sr, target_sr)
+		stream_us = cpu_us_per_frame(resampler.resample, frames)
+		line = f"resample {orig_sr:>5} -> {target_sr:>5}: StreamResampler {stream_us:8.1f} us/frame"
+		if librosa:
+			def librosa_resample(frame):
+				return librosa.resample(frame.astype(np.float32), orig_sr=orig_sr, target_sr=target_sr).astype(np.int16)
+			librosa_resample(frames[0])  # first call pays for numba compilation
+			librosa_us = cpu_us_per_frame(librosa_resample, frames)
+			line += f"  librosa {librosa_us:8.1f} us/frame  ({librosa_us / stream_us:.1f}x)"
+		else:
+			line += "  (librosa not installed, skipping comparison)"
+		print(line)
+
+
+def bench_startup():
+	# import zellostream in a fresh interpreter, as a supervisor restarting the bridge would
+	code = (
+		"import time, sys; start = time.perf_counter(); import zellostream; "
+		"print(time.perf_counter() - start); "
+		f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+	)
+	best = None
+	for _ in range(3):
+		start = time.perf_counter()
+		result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+		elapsed = time.perf_counter() - start
+		if result.returncode != 0:
+			print(f"startup: import zellostream failed\n{result.stderr}")
+			return False
+		best = elapsed if best is None else min(best, elapsed)
+	import_seconds, eager = result.stdout.split("\n")[:2]
+	print(f"startup: interpreter + import {best * 1000:.1f} ms (import zellostream {float(import_seconds) * 1000:.1f} ms), budget {STARTUP_BUDGET * 1000:.0f} ms")
+	ok = True
+	if eager:
+		print(f"startup: FAIL, imported at module load: {eager}")
+		ok = False
+	if best > STARTUP_BUDGET:
+		print("startup: FAIL, over budget")
+		ok = False
+	return ok
+
+
+def alloc_bytes_per_call(func, args, repeat=200):
+	"""Mean heap bytes allocated by one call, freed or not, as seen by tracemalloc."""
+	func(*args)  # warm up caches and lazily created objects
+	tracemalloc.start()
+	total = 0
+	for _ in range(repeat):
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		func(*args)
+		total += tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	return total / repeat
+
+
+def bench_packet_alloc():
+	import opuslib
+	import zellostream
+	from zellopacket import PacketBuilder
+	config = zellostream.parse_config(dict(E2E_CONFIG, zello_ws_url="ws://127.0.0.1/ws"))
+	enc = zellostream.create_encoder(config)
+	zello_chunk = int(config["zello_sample_rate"] * FRAME_SECONDS)
+	frame = synthetic_frames(config["zello_sample_rate"], 1)[0]
+
+	def concatenate(stream_id, data):
+		# how transmit() built packets before PacketBuilder
+		data2 = data.tobytes()
+		out = opuslib.api.encoder.encode(enc, data2, zello_chunk, len(data2) * 2)
+		send_data = bytearray(np.array([1]).astype(">u1").tobytes())
+		send_data = send_data + np.array([stream_id]).astype(">u4").tobytes()
+		send_data = send_data + np.array([0]).astype(">u4").tobytes()
+		return send_data + out
+
+	builder = PacketBuilder(enc, zello_chunk)
+	for name, func in (("concatenate", concatenate), ("PacketBuilder", builder.build)):
+		us = cpu_us_per_frame(lambda data: func(7, data), [frame] * 500)
+		print(f"packet-alloc {name:>13}: {alloc_bytes_per_call(func, (7, frame)):7.0f} bytes allocated, {us:6.1f} us per packet")
+
+
+OPUS_SETTINGS = (
+	("audio 60 ms", {}),
+	("voip 60 ms", {"opus_application": "voip"}),
+	("voip 20 ms", {"opus_application": "voip", "opus_frame_size": 20}),
+	("voip 2x20 ms", {"opus_application": "voip", "opus_frame_size": 20, "opus_frames_per_packet": 2}),
+	("voip 2x60 ms", {"opus_application": "voip", "opus_frames_per_packet": 2}),
+	("voip 16k c3", {"opus_application": "voip", "opus_bitrate": 16000, "opus_complexity": 3}),
+	("voip dtx", {"opus_application": "voip", "opus_dtx": True}),
+)
+WEBSOCKET_OVERHEAD = 6  # bytes of a masked client frame header for a short binary message
+
+
+def bench_opus():
+	import zellostream
+	from zellopacket import PacketBuilder, HEADER
+	seconds = 10
+	for name, settings in OPUS_SETTINGS:
+		config = zellostream.parse_config(dict(E2E_CONFIG, zello_ws_url="ws://127.0.0.1/ws", **settings))
+		chunk = int(config["zello_sample_rate"] * config["packet_seconds"])
+		signal = np.concatenate(synthetic_frames(config["zello_sample_rate"], seconds))
+		signal[len(signal) // 2:] //= 64  # second half is background noise, where DTX can save
+		frames = [signal[i:i + chunk] for i in range(0, len(signal) - chunk + 1, chunk)]
+		builder = PacketBuilder(zellostream.create_encoder(config), chunk, max_payload=8 * 1275)
+		sent = []
+		start = time.process_time()
+		for frame in frames:
+			packet = builder.build(1, frame)
+			if not (config["opus_dtx"] and len(packet) <= HEADER.size + 2):
+				sent.append(len(packet))
+		cpu = time.process_time() - start
+		audio_seconds = len(frames) * config["packet_seconds"]
+		kbps = (sum(sent) + WEBSOCKET_OVERHEAD * len(sent)) * 8 / audio_seconds / 1000
+		print(
+			f"opus {name:>12}: CPU {cpu / audio_seconds * 1000:5.1f} ms per s of audio, "
+			f"{len(sent) / audio_seconds:5.1f} messages/s, {kbps:5.1f} kbit/s on the websocket"
+		)
+
+
+UDP_INGRESS_DATAGRAMS = 200000
+UDP_INGRESS_TGIDS = 8
+UDP_SENDER = """
+import socket, sys, struct
+port, count, tgids = map(int, sys.argv[1:])
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+packets = [struct.pack("<I", tgid) + bytes(320) for tgid in range(tgids)]  # 20 ms at 8 kHz, like trunk-recorder
+for i in range(count):
+	sock.sendto(packets[i % tgids], ("127.0.0.1", port))
+"""
+
+
+def bench_udp_ingress():
+	import threading
+	import zellostream
+	for batch in (1, 64):
+		config = zellostream.parse_config(dict(
+			E2E_CONFIG,
+			zello_ws_url="ws://127.0.0.1/ws",
+			audio_source="UDP",
+			UDP_PORT=0,
+			TGID_in_stream=True,
+			TGID_channels={str(tgid): "bench" for tgid in range(UDP_INGRESS_TGIDS)},
+			udp_receive_buffer=1 << 22,
+			udp_batch=batch,
+		))
+		zellostream.LOG.setLevel(config["logging_level"].upper())
+		sock = zellostream.open_udp_socket(config)
+		zellostream.udp_buffers = zellostream.create_udp_buffers(config)
+		zellostream.processing = True
+		notified = [0]
+
+		def notify(tgid):
+			notified[0] += 1
+
+		receiver = threading.Thread(target=zellostream.udp_rx, args=(sock, config, notify))
+		receiver.start()
+		cpu = time.process_time()
+		start = time.perf_counter()
+		subprocess.run([sys.executable, "-c", UDP_SENDER, str(sock.getsockname()[1]), str(UDP_INGRESS_DATAGRAMS), str(UDP_INGRESS_TGIDS)], check=True)
+		# wait for the receiver to empty the socket
+		received = 0
+		end = time.perf_counter()
+		while True:
+			time.sleep(0.05)
+			total = sum(udp_buffer.received_bytes for udp_buffer in zellostream.udp_buffers.values())
+			if total == received:
+				break
+			received, end = total, time.perf_counter()
+		cpu = time.process_time() - cpu
+		zellostream.processing = False
+		receiver.join()
+		sock.close()
+		datagrams = received // 320
+		print(
+			f"udp-ingress batch {batch:>2}: {datagrams / (end - start):8.0f} datagrams/s, "
+			f"{100 - datagrams * 100 / UDP_INGRESS_DATAGRAMS:4.1f}% lost, "
+			f"CPU {cpu / datagrams * 1e6:5.2f} us per datagram, {notified[0]} wakeups"
+		)
+
+
+class FakeInputStream:
+	"""Sound card input paced at real time: silence until play(), then the given frames, then silence."""
+
+	def __init__(self, frames):
+		self.frames = frames
+		self.read_times = []  # return time of each read of a frame
+		self._reads = 0
+		self._start = None
+		self._playing = False
+
+	def play(self):
+		self._playing = True
+
+	def read(self, count):
+		if self._start is None:
+			self._start = time.perf_counter()
+		self._reads += 1
+		delay = self._start + self._reads * FRAME_SECONDS - time.perf_counter()
+		if delay > 0:
+			time.sleep(delay)
+		if not self._playing:
+			return bytes(count * 2)
+		index = len(self.read_times)
+		self.read_times.append(time.perf_counter())
+		if index < len(self.frames):
+			return self.frames[index].tobytes()
+		return bytes(count * 2)
+
+	def close(self):
+		pass
+
+
+class FakeOutputStream:
+	def __init__(self):
+		self.write_times = []
+		self.written = []  # bytes written so far, after each write
+
+	def write(self, data):
+		self.write_times.append(time.perf_counter())
+		self.written.append((self.written[-1] if self.written else 0) + len(data))
+
+	def close(self):
+		pass
+
+
+def peak_rss_mb():
+	if not resource:
+		return float("nan")
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / (1 << 20) if sys.platform == "darwin" else rss / 1024
+
+
+def report_e2e(name, latencies, packets, cpu, wall, audio_seconds):
+	latencies = np.array(latencies) * 1000
+	p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (float("nan"), float("nan"))
+	print(
+		f"{name}: {packets} packets, latency p50 {p50:.1f} ms p99 {p99:.1f} ms, "
+		f"CPU {cpu / audio_seconds * 1000:.1f} ms per s of audio, {packets / wall:.1f} packets/s, peak RSS {peak_rss_mb():.0f} MB"
+	)
+
+
+async def run_e2e(configdata, feed, audio_input_stream=None, audio_output_stream=None, udp_sock=None):
+	# CPU time includes the fake server, which runs in the same process and event loop
+	import zellostream
+	from fakezello import FakeZelloServer
+	server = FakeZelloServer()
+	await server.start()
+	config = zellostream.parse_config(dict(E2E_CONFIG, zello_ws_url=server.url, **configdata))
+	zellostream.LOG.setLevel(config["logging_level"].upper())
+	zellostream.processing = True
+	if udp_sock:
+		zellostream.udp_buffers = zellostream.create_udp_buffers(config)
+	bridge = asyncio.create_task(zellostream.run_bridge(config, audio_input_stream, audio_output_stream, udp_sock))
+	while not any(command.get("command") == "logon" for command in server.commands):
+		if bridge.done():
+			await bridge  # raises whatever stopped the bridge from starting
+		await asyncio.sleep(0.01)
+	cpu = time.process_time()
+	wall = time.perf_counter()
+	result = await feed(server, config)
+	cpu = time.process_time() - cpu
+	wall = time.perf_counter() - wall
+	bridge.cancel()
+	try:
+		await bridge
+	except asyncio.CancelledError:
+		pass
+	await server.stop()
+	return result, cpu, wall
+
+
+def bench_e2e_udp(paced=True):
+	name = "e2e-tx-udp" if paced else "e2e-tx-udp-burst"
+	frames = synthetic_frames(8000, E2E_SECONDS)
+	udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	udp_sock.settimeout(.5)
+	udp_sock.bind(("127.0.0.1", 0))
+	address = udp_sock.getsockname()
+
+	async def feed(server, config):
+		sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sent = []
+		start = time.perf_counter()
+		for index, frame in enumerate(frames):
+			if paced:
+				await asyncio.sleep(max(0, start + index * FRAME_SECONDS - time.perf_counter()))
+			elif index % 8 == 0:
+				await asyncio.sleep(0)  # let the bridge run, the socket buffer is finite
+			sent.append(time.perf_counter())
+			sender.sendto(frame.tobytes(), address)
+		while len(server.packets) < len(frames) and time.perf_counter() - sent[-1] < 2:
+			await asyncio.sleep(0.01)
+		sender.close()
+		received = [packet[0] for packet in server.packets]
+		return [r - s for s, r in zip(sent, received)], len(received)
+
+	(latencies, packets), cpu, wall = asyncio.run(run_e2e({"audio_source": "UDP", "audio_input_sample_rate": 8000}, feed, udp_sock=udp_sock))
+	udp_sock.close()
+	report_e2e(name, latencies, packets, cpu, wall, len(frames) * FRAME_SECONDS)
+
+
+def bench_e2e_udp_burst():
+	bench_e2e_udp(paced=False)
+
+
+def bench_e2e_soundcard():
+	frames = synthetic_frames(48000, E2E_SECONDS)
+	audio_input_stream = FakeInputStream(frames)
+
+	async def feed(server, config):
+		audio_input_stream.play()
+		# run on through the VOX tail of silence
+		while len(audio_input_stream.read_times) < len(frames) + config["vox_silence_time"] / FRAME_SECONDS + 4:
+			await asyncio.sleep(0.05)
+		received = [packet[0] for packet in server.packets]
+		return [r - s for s, r in zip(audio_input_stream.read_times, received[:len(frames)])], len(received)
+
+	(latencies, packets), cpu, wall = asyncio.run(run_e2e({"audio_source": "Sound Card"}, feed, audio_input_stream, FakeOutputStream()))
+	report_e2e("e2e-tx-soundcard", latencies, packets, cpu, wall, len(frames) * FRAME_SECONDS)
+
+
+def bench_e2e_rx():
+	import opuslib
+	import zellostream
+	audio_output_stream = FakeOutputStream()
+	frames = synthetic_frames(16000, E2E_SECONDS)
+
+	async def feed(server, config):
+		enc = zellostream.create_encoder(config)
+		zello_chunk = int(config["zello_sample_rate"] * FRAME_SECONDS)
+		packets = [opuslib.api.encoder.encode(enc, frame.tobytes(), zello_chunk, zello_chunk * 2) for frame in frames]
+		codec_header = zellostream.start_stream_command(config)["codec_header"]
+		await server.send_stream(codec_header, packets)
+		await asyncio.sleep(config["jitter_max_delay"] + 0.5)
+		# the mixer writes in blocks of its own size: a packet has played once its last sample is written
+		packet_bytes = int(config["audio_output_sample_rate"] * FRAME_SECONDS) * config["audio_output_channels"] * 2
+		played = []
+		for write_time, total in zip(audio_output_stream.write_times, audio_output_stream.written):
+			played.extend([write_time] * (total // packet_bytes - len(played)))
+		return [w - s for s, w in zip(server.sent, played)], len(played)
+
+	(latencies, packets), cpu, wall = asyncio.run(run_e2e({"audio_source": "Sound Card"}, feed, FakeInputStream([]), audio_output_stream))
+	report_e2e("e2e-rx", latencies, packets, cpu, wall, len(frames) * FRAME_SECONDS)
+
+
+BENCHMARKS = {
+	"resample": bench_resample,
+	"packet-alloc": bench_packet_alloc,
+	"opus": bench_opus,
+	"udp-ingress": bench_udp_ingress,
+	"startup": bench_startup,
+	"e2e-tx-udp": bench_e2e_udp,
+	"e2e-tx-udp-burst": bench_e2e_udp_burst,
+	"e2e-tx-soundcard": bench_e2e_soundcard,
+	"e2e-rx": bench_e2e_rx,
+}
+
+
+def main(names):
+	ok = True
+	for name in names or BENCHMARKS:
+		if name not in BENCHMARKS:
+			print(f"unknown benchmark {name}, choose from {', '.join(BENCHMARKS)}")
+			sys.exit(1)
+		if BENCHMARKS[name]() is False:
+			ok = False
+	if not ok:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,189 @@
+"""Local stand-in for the Zello channel API.
+
+Implements just enough of the websocket protocol and of the Zello commands
+(logon, start_stream, stop_stream, on_stream_start/on_stream_stop and binary
+audio packets) to run zellostream.py without network access.  Point
+zellostream.py at it with "zello_ws_url": "ws://127.0.0.1:8765/ws" and a
+zello_work_account_name so no JWT is needed.
+
+Run standalone with: python fakezello.py [port]
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import struct
+import sys
+import time
+
+LOG = logging.getLogger('FakeZello')
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class FakeZelloServer:
+	def __init__(self, host="127.0.0.1", port=0):
+		self.host = host
+		self.port = port
+		self.clients = set()
+		self.commands = []  # every JSON command received, in order
+		self.packets = []  # (receive time, stream_id, packet) for every binary packet received
+		self.sent = []  # send time of every binary packet sent by send_stream
+		self._next_stream_id = 1
+		self._server = None
+
+	@property
+	def url(self):
+		return f"ws://{self.host}:{self.port}/ws"
+
+	async def start(self):
+		self._server = await asyncio.start_server(self._handle, self.host, self.port)
+		self.port = self._server.sockets[0].getsockname()[1]
+		LOG.debug("listening on %s", self.url)
+
+	async def stop(self):
+		for writer in list(self.clients):
+			writer.close()
+		if self._server:
+			self._server.close()
+			await self._server.wait_closed()
+
+	async def send_json(self, writer, data):
+		await self._send_frame(writer, OP_TEXT, json.dumps(data).encode("utf-8"))
+
+	async def send_binary(self, writer, data):
+		await self._send_frame(writer, OP_BINARY, data)
+
+	async def send_stream(self, codec_header, packets, packet_duration=60, stream_id=None, pace=True):
+		"""Play a transmission to every connected client, as if someone was talking on the channel."""
+		if stream_id is None:
+			stream_id = self._new_stream_id()
+		start = {
+			"command": "on_stream_start",
+			"type": "audio",
+			"codec": "opus",
+			"codec_header": codec_header,
+			"packet_duration": packet_duration,
+			"stream_id": stream_id,
+			"channel": "fake",
+			"from": "fake",
+		}
+		for writer in list(self.clients):
+			await self.send_json(writer, start)
+		for packet_id, packet in enumerate(packets):
+			frame = struct.pack(">BII", 1, stream_id, packet_id) + bytes(packet)
+			self.sent.append(time.perf_counter())
+			for writer in list(self.clients):
+				await self.send_binary(writer, frame)
+			if pace:
+				await asyncio.sleep(packet_duration / 1000)
+		for writer in list(self.clients):
+			await self.send_json(writer, {"command": "on_stream_stop", "stream_id": stream_id})
+		return stream_id
+
+	def _new_stream_id(self):
+		stream_id = self._next_stream_id
+		self._next_stream_id += 1
+		return stream_id
+
+	async def _handle(self, reader, writer):
+		try:
+			if not await self._handshake(reader, writer):
+				return
+			self.clients.add(writer)
+			while True:
+				opcode, payload = await self._read_frame(reader)
+				if opcode == OP_TEXT:
+					await self._on_command(writer, json.loads(payload))
+				elif opcode == OP_BINARY:
+					self.packets.append((time.perf_counter(), struct.unpack(">I", payload[1:5])[0], payload))
+				elif opcode == OP_PING:
+					await self._send_frame(writer, OP_PONG, payload)
+				elif opcode == OP_CLOSE:
+					await self._send_frame(writer, OP_CLOSE, payload[:2])
+					break
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			self.clients.discard(writer)
+			writer.close()
+
+	async def _on_command(self, writer, data):
+		self.commands.append(data)
+		command = data.get("command")
+		LOG.debug("command %s", data)
+		if command == "logon":
+			await self.send_json(writer, {"seq": data.get("seq"), "success": True})
+		elif command == "start_stream":
+			await self.send_json(writer, {"seq": data.get("seq"), "success": True, "stream_id": self._new_stream_id()})
+		elif command == "stop_stream":
+			pass
+		elif "seq" in data:
+			await self.send_json(writer, {"seq": data.get("seq"), "success": True})
+
+	async def _handshake(self, reader, writer):
+		request = await reader.readuntil(b"\r\n\r\n")
+		key = None
+		for line in request.split(b"\r\n"):
+			name, _, value = line.partition(b":")
+			if name.strip().lower() == b"sec-websocket-key":
+				key = value.strip()
+		if not key:
+			writer.close()
+			return False
+		accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+		writer.write(
+			b"HTTP/1.1 101 Switching Protocols\r\n"
+			b"Upgrade: websocket\r\n"
+			b"Connection: Upgrade\r\n"
+			b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+		)
+		await writer.drain()
+		return True
+
+	async def _read_frame(self, reader):
+		head = await reader.readexactly(2)
+		opcode = head[0] & 0x0F
+		length = head[1] & 0x7F
+		if length == 126:
+			length = struct.unpack(">H", await reader.readexactly(2))[0]
+		elif length == 127:
+			length = struct.unpack(">Q", await reader.readexactly(8))[0]
+		mask = await reader.readexactly(4) if head[1] & 0x80 else None
+		payload = await reader.readexactly(length)
+		if mask:
+			repeated = (mask * (length // 4 + 1))[:length]
+			payload = (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(length, "big")
+		return opcode, payload
+
+	async def _send_frame(self, writer, opcode, payload):
+		length = len(payload)
+		if length < 126:
+			head = struct.pack(">BB", 0x80 | opcode, length)
+		elif length < 1 << 16:
+			head = struct.pack(">BBH", 0x80 | opcode, 126, length)
+		else:
+			head = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+		writer.write(head + payload)
+		await writer.drain()
+
+
+async def serve(port):
+	server = FakeZelloServer(port=port)
+	await server.start()
+	print(f"fake Zello server on {server.url}")
+	await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(asctime)s %(levelname).1s %(funcName)s: %(message)s', level=logging.DEBUG)
+	try:
+		asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8765))
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,88 @@
+from collections import deque
+from math import ceil
+
+
+class JitterBuffer:
+	"""Reorders received Zello audio packets by packet_id and paces their playout.
+
+	push() stores packets as they arrive and keeps a window of their transit
+	times (arrival time minus the time the packet_id is due); the spread of
+	that window sets the target delay.  pop() is called once per packet
+	duration by the playout loop and says what to decode for the next slot:
+	the packet itself, the following packet decoded for its in-band FEC, or
+	nothing so the decoder conceals the gap.  A packet that arrives after its
+	slot was played is counted as late and makes the buffer one packet deeper;
+	an empty buffer is concealed without giving up on the packet that is due.
+	"""
+
+	def __init__(self, min_delay=0.06, max_delay=0.5, window=50):
+		self.min_delay = min_delay
+		self.max_delay = max_delay
+		self.target_delay = min_delay
+		self._transits = deque(maxlen=window)
+		self.received = 0
+		self.late = 0
+		self.lost = 0
+		self.recovered = 0
+		self.concealed = 0
+		self.dropped = 0
+		self.reset(60)
+
+	def reset(self, packet_duration):
+		"""Start a new stream; the learned target delay carries over."""
+		self.packet_duration = packet_duration / 1000
+		self._packets = {}
+		self._next_id = None
+		self._stretch = 0
+		self._transits.clear()
+
+	@property
+	def depth(self):
+		return len(self._packets)
+
+	@property
+	def target_packets(self):
+		return max(1, ceil(self.target_delay / self.packet_duration))
+
+	def push(self, packet_id, payload, arrival):
+		self.received += 1
+		if self._next_id is not None and packet_id < self._next_id:
+			self.late += 1
+			self.target_delay = min(self.max_delay, self.target_delay + self.packet_duration)
+			self._stretch += 1  # play one concealed frame so the buffer grows by a packet
+			return
+		self._packets[packet_id] = payload
+		self._transits.append(arrival - packet_id * self.packet_duration)
+		spread = max(self._transits) - min(self._transits)
+		self.target_delay = min(self.max_delay, max(self.min_delay, spread + self.packet_duration, self.target_delay * 0.99))
+
+	def pop(self):
+		"""Return (payload, fec) for the next playout slot, payload None meaning conceal it."""
+		if self._stretch:
+			self._stretch -= 1
+			self.concealed += 1
+			return None, False
+		if self._next_id is None:
+			if not self._packets:
+				return None, False
+			self._next_id = min(self._packets)
+		# running too far behind the target, skip ahead rather than keep the extra delay
+		while len(self._packets) > self.target_packets + 2:
+			if self._packets.pop(self._next_id, None) is not None:
+				self.dropped += 1
+			self._next_id += 1
+		payload = self._packets.pop(self._next_id, None)
+		if payload is None and not self._packets:
+			# nothing buffered yet, the packet may still be on its way
+			self.concealed += 1
+			return None, False
+		self._next_id += 1
+		if payload is not None:
+			return payload, False
+		self.lost += 1
+		following = self._packets.get(self._next_id)
+		if following is not None:
+			self.recovered += 1
+			return following, True
+		self.concealed += 1
+		return None, False
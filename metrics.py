@@ -0,0 +1,173 @@
+import json
+import os
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+# seconds, from a fraction of the 60 ms frame budget up to a slow websocket handshake
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Value:
+	"""One labelled counter or gauge.  Plain attribute updates, no locking."""
+
+	__slots__ = ("value", "function")
+
+	def __init__(self):
+		self.value = 0
+		self.function = None
+
+	def inc(self, amount=1):
+		self.value += amount
+
+	def set(self, value):
+		self.value = value
+
+	def set_function(self, function):
+		"""Read the value from function() when metrics are collected instead of storing it."""
+		self.function = function
+
+	def get(self):
+		return self.function() if self.function else self.value
+
+
+class HistogramValue:
+	"""One labelled histogram with fixed, preallocated buckets."""
+
+	__slots__ = ("bounds", "counts", "sum", "count")
+
+	def __init__(self, bounds):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.sum += value
+		self.count += 1
+
+
+class Metric:
+	"""A named metric and its labelled values.
+
+	Call labels() once when setting up a stream or route and keep the
+	returned value object; updating it in the audio loop then costs an
+	attribute increment.
+	"""
+
+	def __init__(self, name, help, kind, labelnames=(), buckets=None):
+		self.name = name
+		self.help = help
+		self.kind = kind
+		self.labelnames = tuple(labelnames)
+		self.buckets = tuple(buckets) if buckets else None
+		self._values = {}
+
+	def labels(self, *labelvalues):
+		value = self._values.get(labelvalues)
+		if value is None:
+			value = HistogramValue(self.buckets) if self.kind == "histogram" else Value()
+			self._values[labelvalues] = value
+		return value
+
+	def inc(self, amount=1):
+		self.labels().inc(amount)
+
+	def set(self, value):
+		self.labels().set(value)
+
+	def set_function(self, function):
+		self.labels().set_function(function)
+
+	def observe(self, value):
+		self.labels().observe(value)
+
+	def _label_text(self, labelvalues, extra=None):
+		pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labelvalues)]
+		if extra:
+			pairs.append(extra)
+		return "{" + ",".join(pairs) + "}" if pairs else ""
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+		for labelvalues, value in list(self._values.items()):
+			if self.kind == "histogram":
+				cumulative = 0
+				for bound, count in zip(value.bounds + (float("inf"),), value.counts):
+					cumulative += count
+					le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+					lines.append(f"{self.name}_bucket{self._label_text(labelvalues, le)} {cumulative}")
+				lines.append(f"{self.name}_sum{self._label_text(labelvalues)} {value.sum}")
+				lines.append(f"{self.name}_count{self._label_text(labelvalues)} {value.count}")
+			else:
+				lines.append(f"{self.name}{self._label_text(labelvalues)} {value.get()}")
+		return lines
+
+	def as_dict(self):
+		result = {}
+		for labelvalues, value in list(self._values.items()):
+			key = ",".join(f"{name}={label}" for name, label in zip(self.labelnames, labelvalues))
+			if self.kind == "histogram":
+				result[key] = {"count": value.count, "sum": value.sum, "buckets": dict(zip([str(b) for b in value.bounds] + ["+Inf"], value.counts))}
+			else:
+				result[key] = value.get()
+		return result
+
+
+class MetricsRegistry:
+	def __init__(self):
+		self._metrics = []
+
+	def _add(self, metric):
+		self._metrics.append(metric)
+		return metric
+
+	def counter(self, name, help, labelnames=()):
+		return self._add(Metric(name, help, "counter", labelnames))
+
+	def gauge(self, name, help, labelnames=()):
+		return self._add(Metric(name, help, "gauge", labelnames))
+
+	def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+		return self._add(Metric(name, help, "histogram", labelnames, buckets))
+
+	def render(self):
+		"""Prometheus text exposition format."""
+		lines = []
+		for metric in self._metrics:
+			lines.extend(metric.render())
+		return "\n".join(lines) + "\n"
+
+	def as_dict(self):
+		return {metric.name: metric.as_dict() for metric in self._metrics}
+
+	def dump_json(self, filename):
+		with open(filename + ".tmp", "w") as f:
+			json.dump(self.as_dict(), f, indent=1)
+		# replace in one step so readers never see a partial file
+		os.replace(filename + ".tmp", filename)
+
+
+def start_http_server(registry, port, host=""):
+	"""Serve registry on http://host:port/metrics from a daemon thread."""
+
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path.split("?")[0] not in ("/metrics", "/"):
+				self.send_error(404)
+				return
+			body = registry.render().encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = ThreadingHTTPServer((host, port), MetricsHandler)
+	server.daemon_threads = True
+	Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+	return server
@@ -0,0 +1,101 @@
+from threading import Condition, Thread
+import numpy as np
+
+from udpbuffer import AudioRingBuffer
+
+
+class MixerSource:
+	"""One decoded stream feeding the mixer, mono int16 at the output sample rate."""
+
+	def __init__(self, mixer, gain, priority, capacity):
+		self.mixer = mixer
+		self.gain = gain
+		self.priority = priority
+		self.buffer = AudioRingBuffer(capacity)
+		self.closed = False
+
+	def write(self, samples):
+		# the ring buffer takes bytes
+		self.buffer.write(memoryview(np.ascontiguousarray(samples, dtype=np.int16)).cast("B"))
+		self.mixer._notify()
+
+	def close(self):
+		"""No more audio; what is buffered is still played."""
+		self.closed = True
+		self.mixer._notify()
+
+
+class Mixer:
+	"""Mixes any number of decoded streams into one output device.
+
+	A dedicated thread takes a fixed size block from every source as soon
+	as one of them has a full block (or a closed source has its last few
+	samples), adds them up with each source's gain into preallocated
+	buffers and writes the block to the output stream.  While a source of
+	higher priority is open, sources of lower priority are ducked by
+	duck_gain.
+	"""
+
+	def __init__(self, output_stream, block, channels=1, volume=1.0, duck_gain=0.25, buffer_seconds=2, sample_rate=48000):
+		self.output_stream = output_stream
+		self.block = block
+		self.channels = channels
+		self.volume = volume
+		self.duck_gain = duck_gain
+		self._capacity = int(buffer_seconds * sample_rate)
+		self._sources = []
+		self._mix = np.zeros(block, dtype=np.float32)
+		self._scaled = np.zeros(block, dtype=np.float32)
+		self._out = np.zeros((block, channels), dtype=np.int16)
+		self._running = True
+		self._condition = Condition()
+		self._thread = Thread(target=self._run, name="mixer", daemon=True)
+		self._thread.start()
+
+	def add_source(self, gain=1.0, priority=0):
+		source = MixerSource(self, gain, priority, self._capacity)
+		with self._condition:
+			self._sources.append(source)
+		return source
+
+	def close(self):
+		with self._condition:
+			self._running = False
+			self._condition.notify()
+		self._thread.join()
+
+	def _notify(self):
+		with self._condition:
+			self._condition.notify()
+
+	def _ready(self):
+		for source in self._sources:
+			depth = source.buffer.depth
+			if depth >= self.block or (source.closed and depth > 0):
+				return True
+		return False
+
+	def _run(self):
+		while True:
+			with self._condition:
+				# drop sources that are finished with
+				self._sources = [source for source in self._sources if not (source.closed and source.buffer.depth == 0)]
+				while self._running and not self._ready():
+					self._condition.wait()
+					self._sources = [source for source in self._sources if not (source.closed and source.buffer.depth == 0)]
+				if not self._running:
+					return
+				sources = list(self._sources)
+			top = max((source.priority for source in sources if not source.closed or source.buffer.depth), default=0)
+			self._mix[:] = 0
+			for source in sources:
+				count = min(source.buffer.depth, self.block)
+				if count == 0:
+					continue
+				data = source.buffer.read(count)
+				gain = source.gain * self.volume * (1 if source.priority >= top else self.duck_gain)
+				np.multiply(data, gain, out=self._scaled[:count])
+				self._mix[:count] += self._scaled[:count]
+			np.clip(self._mix, -32768, 32767, out=self._mix)
+			self._out[:] = self._mix[:, None]
+			self.output_stream.write(self._out.tobytes())
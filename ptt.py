@@ -0,0 +1,142 @@
+import logging
+import os
+import subprocess
+import time
+from threading import Condition, Thread
+
+LOG = logging.getLogger('Zellostream.ptt')
+
+
+class ShellBackend:
+	"""Runs the PTT on/off commands through the shell each time."""
+
+	def __init__(self, on_command, off_command):
+		self._commands = {True: " ".join(on_command), False: " ".join(off_command)}
+
+	def key(self, on):
+		run_command = subprocess.run(self._commands[on], shell=True)
+		LOG.info("PTT %s exited with code %d", "on" if on else "off", run_command.returncode)
+
+	def close(self):
+		pass
+
+
+class ProcessBackend:
+	"""Writes the PTT on/off commands as lines to the stdin of a long-lived helper process."""
+
+	def __init__(self, command, on_command, off_command):
+		self._command = command
+		self._lines = {True: (" ".join(on_command) + "\n").encode(), False: (" ".join(off_command) + "\n").encode()}
+		self._process = None
+
+	def key(self, on):
+		if self._process is None or self._process.poll() is not None:
+			LOG.info("starting PTT helper %s", " ".join(self._command))
+			self._process = subprocess.Popen(self._command, stdin=subprocess.PIPE)
+		self._process.stdin.write(self._lines[on])
+		self._process.stdin.flush()
+		LOG.info("PTT %s", "on" if on else "off")
+
+	def close(self):
+		if self._process and self._process.poll() is None:
+			self._process.stdin.close()
+			try:
+				self._process.wait(1)
+			except subprocess.TimeoutExpired:
+				self._process.terminate()
+
+
+class FileBackend:
+	"""Writes the PTT on/off commands to a device file kept open, e.g. a GPIO value or a serial port."""
+
+	def __init__(self, path, on_command, off_command):
+		self._path = path
+		self._data = {True: " ".join(on_command).encode(), False: " ".join(off_command).encode()}
+		self._fd = None
+
+	def key(self, on):
+		if self._fd is None:
+			self._fd = os.open(self._path, os.O_WRONLY)
+		try:
+			os.lseek(self._fd, 0, os.SEEK_SET)
+		except OSError:
+			pass  # not seekable, e.g. a tty
+		os.write(self._fd, self._data[on])
+		LOG.info("PTT %s", "on" if on else "off")
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+
+class PttController:
+	"""Keys the transmitter from a worker thread so callers never block on it.
+
+	key_up() keys immediately (cancelling any pending key down), key_down()
+	unkeys after a delay.  A key_up() arriving within that delay keeps the
+	transmitter keyed instead of toggling it.  Calls are counted, so with
+	several streams playing at once the transmitter stays keyed until
+	every key_up() has had its key_down().
+	"""
+
+	def __init__(self, backend):
+		self._backend = backend
+		self._keyed = False
+		self._wanted = False
+		self._holders = 0
+		self._off_at = None
+		self._running = True
+		self._condition = Condition()
+		self._thread = Thread(target=self._run, name="PTT", daemon=True)
+		self._thread.start()
+
+	def key_up(self):
+		with self._condition:
+			self._holders += 1
+			self._wanted = True
+			self._off_at = None
+			self._condition.notify()
+
+	def key_down(self, delay=0):
+		with self._condition:
+			self._holders = max(0, self._holders - 1)
+			if self._holders == 0:
+				self._off_at = time.monotonic() + delay
+				self._condition.notify()
+
+	def close(self):
+		with self._condition:
+			self._running = False
+			self._condition.notify()
+		self._thread.join()
+		if self._keyed:
+			self._key(False)
+		self._backend.close()
+
+	def _key(self, on):
+		try:
+			self._backend.key(on)
+			self._keyed = on
+			return True
+		except Exception as ex:
+			LOG.error("exception keying PTT %s: %s", "on" if on else "off", ex)
+			return False
+
+	def _run(self):
+		while True:
+			with self._condition:
+				while True:
+					if not self._running:
+						return
+					now = time.monotonic()
+					if self._off_at is not None and now >= self._off_at:
+						self._wanted = False
+						self._off_at = None
+					if self._wanted != self._keyed:
+						wanted = self._wanted
+						break
+					self._condition.wait(None if self._off_at is None else self._off_at - now)
+			if not self._key(wanted):
+				with self._condition:
+					self._condition.wait(1)  # don't spin on a failing backend
@@ -1,62 +1,149 @@
-import pulsectl
+import logging
 import os
+import threading
+import time
+import pulsectl
+
+LOG = logging.getLogger('Zellostream.pulseaudio')
+
+FACILITIES = ('source', 'sink', 'source_output', 'sink_input')
+RECONNECT_SECONDS = 2
 
 class PulseAudioHandler:
+    """Looks up PulseAudio devices and moves this process's streams between them.
+
+    Sources, sinks and our own streams are cached, so lookups don't go to
+    the server.  Once a route is set with route_source_output() or
+    route_sink_input(), a background thread follows PulseAudio events to
+    keep the cache current and moves our stream back to the named device
+    whenever it (re)appears, e.g. after a USB sound card re-enumerates or
+    PulseAudio restarts, without reopening the stream.
+    """
+
     def __init__(self):
         self._pulse = pulsectl.Pulse('zello-pulseaudio')
+        self._lock = threading.Lock()
+        self._sources = {}  # name: index
+        self._sinks = {}
+        self._source_outputs = {}  # index of our own stream: index of the device it is on
+        self._sink_inputs = {}
+        self._source_name = None  # routes to keep
+        self._sink_name = None
+        self._watcher = None
+        self._refresh(FACILITIES)
 
     def list_sources(self):
-        result = {}
-        pulse_sources = self._pulse.source_list()
-        for pulse_source in pulse_sources:
-            result[pulse_source.name] = pulse_source.index
-        return result
+        return dict(self._sources)
 
     def list_sinks(self):
-        result = {}
-        pulse_sinks = self._pulse.sink_list()
-        for pulse_sink in pulse_sinks:
-            result[pulse_sink.name] = pulse_sink.index
-        return result
+        return dict(self._sinks)
 
     def get_source_index(self, pulse_name):
-        pulse_sources = self._pulse.source_list()
-        for pulse_source in pulse_sources:
-            if pulse_source.name == pulse_name:
-                return pulse_source.index
-        return None
+        return self._sources.get(pulse_name)
 
     def get_sink_index(self, pulse_name):
-        pulse_sinks = self._pulse.sink_list()
-        for pulse_sink in pulse_sinks:
-            if pulse_sink.name == pulse_name:
-                return pulse_sink.index
-        return None
+        return self._sinks.get(pulse_name)
 
     def get_own_sink_input_index(self):
-        pulse_sink_inputs = self._pulse.sink_input_list()
-        for pulse_sink_input in pulse_sink_inputs:
-            pid = int(pulse_sink_input.proplist.get("application.process.id"))
-            if pid == os.getpid():
-                return pulse_sink_input.index
-        return None
+        return next(iter(self._sink_inputs), None)
 
     def get_own_source_output_index(self):
-        pulse_source_outputs = self._pulse.source_output_list()
-        for pulse_source_output in pulse_source_outputs:
-            pid = int(pulse_source_output.proplist.get("application.process.id"))
-            if pid == os.getpid():
-                return pulse_source_output.index
-        return None
+        return next(iter(self._source_outputs), None)
 
     def move_sink_input(self, sink_input_index, sink_index):
         try:
-            self._pulse.sink_input_move(sink_input_index, sink_index)
+            with self._lock:
+                self._pulse.sink_input_move(sink_input_index, sink_index)
         except Exception as ex:
-            print(f'PulseAudioHandler.move_sink_input: cannot move sink input: {ex}')
+            LOG.error('cannot move sink input %s to sink %s: %s', sink_input_index, sink_index, ex)
 
     def move_source_output(self, source_output_index, source_index):
         try:
-            self._pulse.source_output_move(source_output_index, source_index)
+            with self._lock:
+                self._pulse.source_output_move(source_output_index, source_index)
         except Exception as ex:
-            print(f'PulseAudioHandler.move_source_output: cannot move source output: {ex}')
+            LOG.error('cannot move source output %s to source %s: %s', source_output_index, source_index, ex)
+
+    def route_source_output(self, source_name):
+        """Keep our recording stream on the named source from now on."""
+        self._source_name = source_name
+        self._refresh(('source_output',))  # the stream was probably opened since the last refresh
+        self._reroute()
+        self._watch()
+
+    def route_sink_input(self, sink_name):
+        """Keep our playback stream on the named sink from now on."""
+        self._sink_name = sink_name
+        self._refresh(('sink_input',))
+        self._reroute()
+        self._watch()
+
+    def _refresh(self, facilities):
+        with self._lock:
+            if 'source' in facilities:
+                self._sources = {source.name: source.index for source in self._pulse.source_list()}
+            if 'sink' in facilities:
+                self._sinks = {sink.name: sink.index for sink in self._pulse.sink_list()}
+            if 'source_output' in facilities:
+                self._source_outputs = {output.index: output.source for output in self._pulse.source_output_list() if _is_own(output)}
+            if 'sink_input' in facilities:
+                self._sink_inputs = {sink_input.index: sink_input.sink for sink_input in self._pulse.sink_input_list() if _is_own(sink_input)}
+
+    def _reroute(self):
+        source_index = self._sources.get(self._source_name)
+        if self._source_name and source_index is None:
+            LOG.warning('pulseaudio source %s not found', self._source_name)
+        if source_index is not None:
+            for output_index, current in self._source_outputs.items():
+                if current != source_index:
+                    LOG.info('moving pulseaudio source output %d to source %d', output_index, source_index)
+                    self.move_source_output(output_index, source_index)
+        sink_index = self._sinks.get(self._sink_name)
+        if self._sink_name and sink_index is None:
+            LOG.warning('pulseaudio sink %s not found', self._sink_name)
+        if sink_index is not None:
+            for input_index, current in self._sink_inputs.items():
+                if current != sink_index:
+                    LOG.info('moving pulseaudio sink input %d to sink %d', input_index, sink_index)
+                    self.move_sink_input(input_index, sink_index)
+
+    def _watch(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_events, name='pulseaudio', daemon=True)
+            self._watcher.start()
+
+    def _watch_events(self):
+        # the event client only collects which facilities changed: pulsectl can't make queries from its callback
+        changed = set()
+
+        def on_event(event):
+            # facility is a pulsectl EnumValue: it compares and hashes as its name, but str() gives its repr
+            changed.add(event.facility)
+            raise pulsectl.PulseLoopStop
+
+        while True:
+            try:
+                with pulsectl.Pulse('zello-pulseaudio-events') as events:
+                    events.event_mask_set(*FACILITIES)
+                    events.event_callback_set(on_event)
+                    while True:
+                        events.event_listen()
+                        facilities, changed = changed, set()
+                        self._refresh(facilities)
+                        self._reroute()
+            except pulsectl.PulseError as ex:
+                # PulseAudio went away: reconnect, then catch up on everything missed meanwhile
+                LOG.warning('lost pulseaudio connection: %s', ex)
+                time.sleep(RECONNECT_SECONDS)
+                try:
+                    with self._lock:
+                        self._pulse.close()
+                        self._pulse = pulsectl.Pulse('zello-pulseaudio')
+                    self._refresh(FACILITIES)
+                    self._reroute()
+                except pulsectl.PulseError as ex:
+                    LOG.warning('cannot reconnect to pulseaudio: %s', ex)
+
+
+def _is_own(stream):
+    return stream.proplist.get('application.process.id') == str(os.getpid())
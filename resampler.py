@@ -0,0 +1,61 @@
+from math import gcd, ceil
+import numpy as np
+
+
+class StreamResampler:
+	"""Polyphase FIR resampler that keeps its filter state between chunks.
+
+	One instance is meant to live for a whole audio stream.  Each call to
+	resample() consumes a chunk of int16 (or float) samples and returns the
+	int16 samples that can be produced so far; the filter history and the
+	output phase carry over to the next call so there are no discontinuities
+	at chunk boundaries.
+	"""
+
+	def __init__(self, orig_sr, target_sr, zero_crossings=8, beta=8.6):
+		self.orig_sr = int(orig_sr)
+		self.target_sr = int(target_sr)
+		g = gcd(self.orig_sr, self.target_sr)
+		self.up = self.target_sr // g
+		self.down = self.orig_sr // g
+		self.passthrough = self.up == self.down
+		if self.passthrough:
+			return
+		# low pass at the lower of the two Nyquist frequencies, designed at the upsampled rate
+		factor = max(self.up, self.down)
+		self.taps_per_phase = ceil(2 * zero_crossings * factor / self.up)
+		num_taps = self.taps_per_phase * self.up
+		cutoff = 0.5 / factor
+		n = np.arange(num_taps) - (num_taps - 1) / 2
+		h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(num_taps, beta)
+		h *= self.up / h.sum()
+		# phases[p, j] = h[p + j * up]; reversed along j so a dot with the input window works
+		self.phases = h.reshape(self.taps_per_phase, self.up).T[:, ::-1].astype(np.float32).copy()
+		self.reset()
+
+	def reset(self):
+		"""Forget the filter history, e.g. at the start of a new transmission."""
+		if self.passthrough:
+			return
+		self._history = np.zeros(self.taps_per_phase - 1, dtype=np.float32)
+		self._pos = 0  # next output position in 1/up input sample units, relative to the current chunk
+
+	def resample(self, data):
+		data = np.asarray(data)
+		if self.passthrough:
+			return data.astype(np.int16, copy=False)
+		if len(data) == 0:
+			return np.zeros(0, dtype=np.int16)
+		chunk = data.astype(np.float32, copy=False)
+		extended = np.concatenate((self._history, chunk))
+		total = len(chunk) * self.up
+		count = max(0, -(-(total - self._pos) // self.down))
+		positions = self._pos + self.down * np.arange(count)
+		index = positions // self.up
+		phase = positions % self.up
+		# window of taps_per_phase input samples ending at each output's input index
+		windows = np.lib.stride_tricks.sliding_window_view(extended, self.taps_per_phase)[index]
+		out = np.einsum("ij,ij->i", windows, self.phases[phase])
+		self._pos = self._pos + self.down * count - total
+		self._history = extended[len(extended) - (self.taps_per_phase - 1):]
+		return np.clip(np.rint(out), -32768, 32767).astype(np.int16)
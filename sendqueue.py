@@ -0,0 +1,82 @@
+import asyncio
+import time
+from collections import deque
+
+
+class SendQueue:
+	"""Outbound websocket messages for one connection, in order.
+
+	Commands (str) are always kept.  Audio packets (anything else) are
+	bounded two ways: at most max_audio of them wait at once, the oldest
+	making way for a new one, and a packet that has waited longer than
+	max_age by the time its turn comes is dropped, since audio that late
+	only holds up what follows it.  A producer that would rather wait than
+	have audio dropped awaits room() before each put().
+	"""
+
+	def __init__(self, max_audio, max_age):
+		self.max_audio = max_audio
+		self.max_age = max_age
+		self.audio = 0  # audio packets waiting
+		self.dropped_overflow = 0
+		self.dropped_stale = 0
+		self._messages = deque()  # (time queued, message)
+		self._ready = asyncio.Event()
+		self._room = asyncio.Event()  # set when audio drops below max_audio
+		self._sending = 0  # 1 from get() until done()
+
+	def __len__(self):
+		"""Messages waiting or being sent."""
+		return len(self._messages) + self._sending
+
+	def put(self, message):
+		if type(message) != str:
+			if self.audio >= self.max_audio:
+				self._drop_oldest_audio()
+			self.audio += 1
+		self._messages.append((time.perf_counter(), message))
+		self._ready.set()
+
+	async def room(self):
+		"""Wait until an audio packet can be put without dropping another."""
+		while self.audio >= self.max_audio:
+			self._room.clear()
+			await self._room.wait()
+
+	async def get(self):
+		"""Return the next message worth sending, and when it was queued."""
+		while True:
+			while not self._messages:
+				self._ready.clear()
+				await self._ready.wait()
+			queued, message = self._messages.popleft()
+			if type(message) == str:
+				self._sending = 1
+				return queued, message
+			self.audio -= 1
+			self._room.set()
+			if not self.is_stale(queued):
+				self._sending = 1
+				return queued, message
+			self.dropped_stale += 1
+
+	def done(self):
+		"""The message from get() has been sent, or given up on."""
+		self._sending = 0
+
+	def is_stale(self, queued):
+		return time.perf_counter() - queued > self.max_age
+
+	def clear(self):
+		self._messages.clear()
+		self.audio = 0
+		self._sending = 0
+		self._room.set()
+
+	def _drop_oldest_audio(self):
+		for index, (queued, message) in enumerate(self._messages):
+			if type(message) != str:
+				del self._messages[index]
+				self.audio -= 1
+				self.dropped_overflow += 1
+				return
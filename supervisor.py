@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+logging.basicConfig(format='%(asctime)s %(levelname).1s %(funcName)s: %(message)s', level=logging.INFO)
+LOG = logging.getLogger('Zellostream.supervisor')
+
+BRIDGE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zellostream.py")
+STOP_SECONDS = 5  # a bridge gets this long to log off after SIGINT before it is killed
+STABLE_SECONDS = 60  # a bridge that ran this long before it exited is restarted without delay
+
+
+class ConfigException(Exception):
+	pass
+
+
+def get_supervisor_config(filename):
+	with open(filename) as f:
+		configdata = json.load(f)
+	directory = os.path.dirname(os.path.abspath(filename))
+	config = {}
+	config["control_socket"] = os.path.join(directory, configdata.get("control_socket", "zellostream.sock"))
+	config["state_dir"] = os.path.join(directory, configdata.get("state_dir", "."))
+	config["restart_delay"] = configdata.get("restart_delay", 1)
+	config["restart_max_delay"] = configdata.get("restart_max_delay", 60)
+	config["metrics_interval"] = configdata.get("metrics_interval", 10)
+	config["logging_level"] = configdata.get("logging_level", "info")
+	bridges = configdata.get("bridges")
+	if not bridges:
+		raise ConfigException("bridges MUST LIST AT LEAST ONE BRIDGE")
+	config["bridges"] = []
+	for bridge in bridges:
+		if isinstance(bridge, str):
+			bridge = {"config": bridge}
+		path = os.path.join(directory, bridge["config"])
+		name = bridge.get("name", os.path.splitext(os.path.basename(path))[0])
+		if any(name == other["name"] for other in config["bridges"]):
+			raise ConfigException(f"BRIDGE NAME {name} IS USED TWICE")
+		cpus = bridge.get("cpus")
+		config["bridges"].append({"name": name, "config": path, "cpus": [cpus] if isinstance(cpus, int) else cpus})
+	return config
+
+
+class Bridge:
+	"""One zellostream.py worker process, restarted with backoff when it exits with an error.
+
+	The bridge runs in the directory of its config file, as zellostream.py
+	does when started by hand, and writes its metrics to a JSON file in the
+	state directory for the supervisor to pass on.  A bridge that exits
+	cleanly, e.g. at the end of its audio file, is left stopped.
+	"""
+
+	def __init__(self, config, bridge):
+		self.name = bridge["name"]
+		self.config_file = bridge["config"]
+		self.cpus = bridge["cpus"]
+		self.restart_delay = config["restart_delay"]
+		self.restart_max_delay = config["restart_max_delay"]
+		self.metrics_interval = config["metrics_interval"]
+		self.metrics_file = os.path.join(config["state_dir"], f"{self.name}.metrics.json")
+		self.process = None
+		self.state = "starting"
+		self.started = None
+		self.restarts = 0
+		self.exit_code = None
+		self.delay = 0
+		self._wake = asyncio.Event()  # cuts a restart delay short
+		self._stopping = False
+		self._restarting = False
+
+	async def run(self):
+		while not self._stopping:
+			command = [sys.executable, BRIDGE_SCRIPT, "--config", self.config_file, "--metrics-json-file", self.metrics_file, "--metrics-interval", str(self.metrics_interval)]
+			if self.cpus:
+				command += ["--cpus", ",".join(str(cpu) for cpu in self.cpus)]
+			try:
+				self.process = await asyncio.create_subprocess_exec(*command, cwd=os.path.dirname(self.config_file), start_new_session=True, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+			except OSError as ex:
+				LOG.error("cannot start bridge %s: %s", self.name, ex)
+				self.exit_code = None
+			else:
+				self.state = "running"
+				self.started = time.monotonic()
+				LOG.info("bridge %s started, pid %d", self.name, self.process.pid)
+				await self._log_output()
+				self.exit_code = await self.process.wait()
+				if self._stopping:
+					break
+				if self._restarting:
+					self._restarting = False
+					LOG.info("bridge %s restarted on request", self.name)
+					self.restarts += 1
+					continue
+				if self.exit_code == 0:
+					LOG.info("bridge %s finished", self.name)
+					self.state = "finished"
+					return
+				if time.monotonic() - self.started >= STABLE_SECONDS:
+					self.delay = 0
+			self.delay = min(self.delay * 2, self.restart_max_delay) if self.delay else self.restart_delay
+			LOG.warning("bridge %s exited with status %s, restarting in %g s", self.name, self.exit_code, self.delay)
+			self.state = "backoff"
+			self._wake.clear()
+			try:
+				await asyncio.wait_for(self._wake.wait(), self.delay)
+			except asyncio.TimeoutError:
+				pass
+			self.restarts += 1
+		self.state = "stopped"
+
+	async def _log_output(self):
+		# the bridge logs to stderr; pass its lines on marked with its name
+		while True:
+			line = await self.process.stdout.readline()
+			if not line:
+				return
+			sys.stderr.write(f"[{self.name}] {line.decode(errors='replace')}")
+
+	def restart(self):
+		"""Restart now, skipping any backoff delay."""
+		if self.state == "running":
+			self._restarting = True
+			self.process.send_signal(signal.SIGINT)
+		else:
+			self._wake.set()
+
+	async def stop(self):
+		self._stopping = True
+		self._wake.set()
+		if self.process and self.process.returncode is None:
+			self.process.send_signal(signal.SIGINT)
+			try:
+				await asyncio.wait_for(self.process.wait(), STOP_SECONDS)
+			except asyncio.TimeoutError:
+				LOG.warning("bridge %s did not stop, killing it", self.name)
+				self.process.kill()
+				await self.process.wait()
+
+	def status(self):
+		status = {"state": self.state, "pid": self.process.pid if self.state == "running" else None, "restarts": self.restarts, "exit_code": self.exit_code, "cpus": self.cpus}
+		if self.state == "running":
+			status["uptime"] = round(time.monotonic() - self.started, 1)
+		if self.state == "backoff":
+			status["restart_delay"] = self.delay
+		try:
+			age = time.time() - os.stat(self.metrics_file).st_mtime
+		except OSError:
+			age = None
+		status["metrics_age"] = None if age is None else round(age, 1)
+		# running, and the bridge's own loop is still writing metrics
+		status["healthy"] = self.state == "running" and (time.monotonic() - self.started < 2 * self.metrics_interval or (age is not None and age < 2 * self.metrics_interval))
+		return status
+
+	def metrics(self):
+		try:
+			with open(self.metrics_file) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+
+class Supervisor:
+	"""Runs every configured bridge at once and answers on a local control socket.
+
+	The control socket is a Unix socket taking one command per line and
+	answering each with one line of JSON:
+	- status: state, pid, restarts, uptime and health of every bridge
+	- metrics: the latest metrics of every bridge, as in metrics_json_file
+	- restart NAME: restart a bridge now
+	"""
+
+	def __init__(self, config):
+		self.config = config
+		self.bridges = {bridge["name"]: Bridge(config, bridge) for bridge in config["bridges"]}
+
+	async def run(self):
+		os.makedirs(self.config["state_dir"], exist_ok=True)
+		if os.path.exists(self.config["control_socket"]):
+			os.unlink(self.config["control_socket"])  # left over from a supervisor that was killed
+		server = await asyncio.start_unix_server(self._serve, self.config["control_socket"])
+		LOG.info("control socket %s", self.config["control_socket"])
+		loop = asyncio.get_running_loop()
+		stop = asyncio.Event()
+		for signum in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(signum, stop.set)
+		# the bridges start side by side, not one after another
+		tasks = [asyncio.create_task(bridge.run()) for bridge in self.bridges.values()]
+		finished = asyncio.create_task(asyncio.wait(tasks))
+		await asyncio.wait([finished, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+		LOG.info("stopping bridges")
+		server.close()
+		await asyncio.gather(*(bridge.stop() for bridge in self.bridges.values()))
+		await asyncio.gather(*tasks)
+		os.unlink(self.config["control_socket"])
+
+	async def _serve(self, reader, writer):
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				writer.write(json.dumps(self.command(line.decode(errors="replace").split())).encode() + b"\n")
+				await writer.drain()
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	def command(self, words):
+		if words == ["status"]:
+			return {name: bridge.status() for name, bridge in self.bridges.items()}
+		if words == ["metrics"]:
+			return {name: bridge.metrics() for name, bridge in self.bridges.items()}
+		if len(words) == 2 and words[0] == "restart":
+			bridge = self.bridges.get(words[1])
+			if bridge is None:
+				return {"error": f"no bridge {words[1]}"}
+			if bridge.state in ("finished", "stopped"):
+				return {"error": f"bridge {words[1]} is {bridge.state}"}
+			bridge.restart()
+			return {"ok": True}
+		return {"error": "commands are status, metrics and restart NAME"}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run several zellostream.py bridges, each in its own process")
+	parser.add_argument("config", nargs="?", default="supervisor.json", help="supervisor config file listing the bridges")
+	args = parser.parse_args()
+	try:
+		config = get_supervisor_config(args.config)
+	except (OSError, ValueError, KeyError, ConfigException) as ex:
+		LOG.critical("configuration error: %s", ex)
+		sys.exit(1)
+	LOG.setLevel(logging.getLevelName(config["logging_level"].upper()))
+	asyncio.run(Supervisor(config).run())
+
+if __name__ == "__main__":
+	main()
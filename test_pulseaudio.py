@@ -0,0 +1,208 @@
+"""Tests for PulseAudioHandler against an in-process stand-in for pulsectl.
+
+Run with: python3 -m unittest test_pulseaudio
+"""
+import os
+import queue
+import sys
+import time
+import types
+import unittest
+
+
+class PulseError(Exception):
+    pass
+
+
+class PulseDisconnected(PulseError):
+    pass
+
+
+class PulseLoopStop(Exception):
+    pass
+
+
+class EnumValue:
+    """Like pulsectl.EnumValue: equal to and hashed as its name, with a repr but no __str__."""
+
+    def __init__(self, t, value):
+        self.t, self.value = t, value
+
+    def __eq__(self, other):
+        if isinstance(other, EnumValue):
+            return (self.t, self.value) == (other.t, other.value)
+        return self.value == other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return f'<EnumValue {self.t}={self.value}>'
+
+
+class FakeServer:
+    """The state of a PulseAudio server: devices, our streams, and the events it sends."""
+
+    def __init__(self):
+        self.sources = {1: 'usb-mic'}  # index: name
+        self.sinks = {5: 'usb-speaker'}
+        self.source_outputs = {10: 0}  # our recording stream, on the default source
+        self.sink_inputs = {20: 0}
+        self.events = queue.Queue()
+        self.queries = 0
+        self.up = True
+
+    def event(self, facility):
+        self.events.put(types.SimpleNamespace(facility=EnumValue('event-facility', facility), t=EnumValue('event-type', 'change'), index=0))
+
+    def plug(self, facility, devices, index, name):
+        devices[index] = name
+        self.event(facility)
+
+    def unplug(self, facility, devices, index):
+        del devices[index]
+        self.event(facility)
+
+    def stop(self):
+        self.up = False
+        self.events.put(None)
+
+    def restart(self):
+        # our streams come back on the default devices
+        self.source_outputs = {index: 0 for index in self.source_outputs}
+        self.sink_inputs = {index: 0 for index in self.sink_inputs}
+        self.up = True
+
+
+class FakePulse:
+    server = None  # the server new clients connect to
+
+    def __init__(self, name):
+        self.server = FakePulse.server
+        if not self.server.up:
+            raise PulseError('connection refused')
+        self.callback = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _query(self):
+        if not self.server.up:
+            raise PulseDisconnected('server went away')
+        self.server.queries += 1
+
+    def source_list(self):
+        self._query()
+        return [types.SimpleNamespace(index=index, name=name) for index, name in self.server.sources.items()]
+
+    def sink_list(self):
+        self._query()
+        return [types.SimpleNamespace(index=index, name=name) for index, name in self.server.sinks.items()]
+
+    def source_output_list(self):
+        self._query()
+        own = {'application.process.id': str(os.getpid())}
+        outputs = [types.SimpleNamespace(index=index, source=source, proplist=own) for index, source in self.server.source_outputs.items()]
+        return outputs + [types.SimpleNamespace(index=99, source=0, proplist={'application.process.id': '1'})]
+
+    def sink_input_list(self):
+        self._query()
+        own = {'application.process.id': str(os.getpid())}
+        return [types.SimpleNamespace(index=index, sink=sink, proplist=own) for index, sink in self.server.sink_inputs.items()]
+
+    def source_output_move(self, index, source):
+        self._query()
+        self.server.source_outputs[index] = source
+        self.server.event('source_output')
+
+    def sink_input_move(self, index, sink):
+        self._query()
+        self.server.sink_inputs[index] = sink
+        self.server.event('sink_input')
+
+    def event_mask_set(self, *facilities):
+        pass
+
+    def event_callback_set(self, callback):
+        self.callback = callback
+
+    def event_listen(self):
+        while True:
+            event = self.server.events.get()
+            if event is None:
+                raise PulseDisconnected('server went away')
+            try:
+                self.callback(event)
+            except PulseLoopStop:
+                return
+
+
+sys.modules['pulsectl'] = types.SimpleNamespace(Pulse=FakePulse, PulseError=PulseError, PulseLoopStop=PulseLoopStop)
+import pulseaudio  # noqa: E402
+
+pulseaudio.RECONNECT_SECONDS = 0.05
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class PulseAudioHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakePulse.server = FakeServer()
+        self.handler = pulseaudio.PulseAudioHandler()
+
+    def test_lookups_come_from_the_cache(self):
+        queries = self.server.queries
+        self.assertEqual(self.handler.get_source_index('usb-mic'), 1)
+        self.assertEqual(self.handler.get_sink_index('usb-speaker'), 5)
+        self.assertIsNone(self.handler.get_source_index('missing'))
+        self.assertEqual(self.handler.list_sinks(), {'usb-speaker': 5})
+        self.assertEqual(self.handler.get_own_source_output_index(), 10)  # not 99, another process's stream
+        self.assertEqual(self.handler.get_own_sink_input_index(), 20)
+        self.assertEqual(self.server.queries, queries)
+
+    def test_route_moves_our_streams(self):
+        self.handler.route_source_output('usb-mic')
+        self.handler.route_sink_input('usb-speaker')
+        self.assertEqual(self.server.source_outputs, {10: 1})
+        self.assertEqual(self.server.sink_inputs, {20: 5})
+
+    def test_replugged_device_gets_the_stream_back(self):
+        self.handler.route_source_output('usb-mic')
+        self.server.unplug('source', self.server.sources, 1)
+        self.server.source_outputs[10] = 0  # PulseAudio falls back to the default source
+        self.server.event('source_output')
+        self.assertTrue(wait_for(lambda: self.handler.get_source_index('usb-mic') is None))
+        self.assertEqual(self.server.source_outputs, {10: 0})
+        # the card re-enumerates with a new index
+        self.server.plug('source', self.server.sources, 3, 'usb-mic')
+        self.assertTrue(wait_for(lambda: self.server.source_outputs == {10: 3}))
+        self.assertEqual(self.handler.get_source_index('usb-mic'), 3)
+
+    def test_reroutes_after_pulseaudio_restarts(self):
+        self.handler.route_sink_input('usb-speaker')
+        self.assertEqual(self.server.sink_inputs, {20: 5})
+        self.server.stop()
+        time.sleep(0.1)  # reconnect attempts fail while it is down
+        self.server.restart()
+        self.assertTrue(wait_for(lambda: self.server.sink_inputs == {20: 5}))
+        # and events are followed again on the new connection
+        self.server.sinks = {}
+        self.server.plug('sink', self.server.sinks, 6, 'usb-speaker')
+        self.assertTrue(wait_for(lambda: self.server.sink_inputs == {20: 6}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import time
+from threading import Lock
+import numpy as np
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class AudioRingBuffer:
+	"""Fixed capacity int16 ring buffer fed from the UDP receive thread.
+
+	Writes copy the datagram payload into preallocated storage, reads return
+	a view of that storage (or of a preallocated scratch array when the
+	requested span wraps around), so neither side allocates per packet.
+	When the buffer is full the overflow policy decides whether the oldest
+	buffered audio or the incoming audio is dropped.
+	"""
+
+	def __init__(self, capacity, overflow_policy=DROP_OLDEST):
+		if overflow_policy not in (DROP_OLDEST, DROP_NEWEST):
+			raise ValueError(f"unknown overflow policy {overflow_policy}")
+		self.capacity = int(capacity)
+		self.overflow_policy = overflow_policy
+		self._storage = np.zeros(self.capacity, dtype=np.int16)
+		self._scratch = np.zeros(self.capacity, dtype=np.int16)
+		self._read_index = 0
+		self._depth = 0
+		self._lock = Lock()
+		self.dropped_bytes = 0
+		self.received_bytes = 0
+
+	@property
+	def depth(self):
+		"""Number of buffered samples."""
+		return self._depth
+
+	@property
+	def depth_bytes(self):
+		return self._depth * 2
+
+	def write(self, data):
+		"""Append the int16 samples in data (any buffer object)."""
+		samples = np.frombuffer(data, dtype=np.int16, count=len(data) // 2)
+		count = len(samples)
+		with self._lock:
+			self.received_bytes += count * 2
+			free = self.capacity - self._depth
+			if count > free:
+				if self.overflow_policy == DROP_NEWEST:
+					self.dropped_bytes += (count - free) * 2
+					samples = samples[:free]
+					count = free
+				else:
+					if count > self.capacity:
+						self.dropped_bytes += (count - self.capacity) * 2
+						samples = samples[count - self.capacity:]
+						count = self.capacity
+					overrun = count - free
+					if overrun > 0:
+						self.dropped_bytes += overrun * 2
+						self._read_index = (self._read_index + overrun) % self.capacity
+						self._depth -= overrun
+			if count == 0:
+				return 0
+			start = (self._read_index + self._depth) % self.capacity
+			first = min(count, self.capacity - start)
+			self._storage[start:start + first] = samples[:first]
+			if first < count:
+				self._storage[:count - first] = samples[first:]
+			self._depth += count
+			return count
+
+	def read(self, count):
+		"""Remove and return count samples, or None if not enough are buffered.
+
+		The returned array is a view that stays valid until the buffer wraps
+		around onto it again; copy it if it has to be kept.
+		"""
+		with self._lock:
+			if self._depth < count:
+				return None
+			start = self._read_index
+			if start + count <= self.capacity:
+				data = self._storage[start:start + count]
+			else:
+				first = self.capacity - start
+				data = self._scratch[:count]
+				data[:first] = self._storage[start:]
+				data[first:] = self._storage[:count - first]
+			self._read_index = (start + count) % self.capacity
+			self._depth -= count
+			return data
+
+	def clear(self):
+		with self._lock:
+			self._read_index = 0
+			self._depth = 0
+
+
+class SourceMixer:
+	"""Buffers audio per sender and mixes the senders into one stream.
+
+	write() puts each datagram into its sender's own AudioRingBuffer, so
+	two recorders sending to the same port at once are summed instead of
+	interleaved.  read(count) mixes count samples once a sender has that
+	many; senders that are part way through a frame and sent something in
+	the last max_delay seconds are waited for, up to max_delay of extra
+	audio, so their frames line up.  Samples are added up in int32 with
+	each sender's gain and clipped back to int16.  Senders that have sent
+	nothing for idle_timeout seconds are forgotten.
+
+	With a single sender its audio is passed through untouched, as from an
+	AudioRingBuffer, which this class stands in for.
+	"""
+
+	def __init__(self, capacity, overflow_policy=DROP_OLDEST, max_delay_samples=0, max_delay=0.1, idle_timeout=2, gains=None):
+		if overflow_policy not in (DROP_OLDEST, DROP_NEWEST):
+			raise ValueError(f"unknown overflow policy {overflow_policy}")
+		self.capacity = int(capacity)
+		self.overflow_policy = overflow_policy
+		self.max_delay_samples = max_delay_samples
+		self.max_delay = max_delay
+		self.idle_timeout = idle_timeout
+		self.gains = gains or {}  # "host" or "host:port": gain
+		self.sources = {}  # address: [AudioRingBuffer, gain as a multiple of 1/256, last write time]
+		self._lock = Lock()
+		self._removed_dropped = 0
+		self._removed_received = 0
+		self._mix = np.zeros(0, dtype=np.int32)
+		self._scaled = np.zeros(0, dtype=np.int32)
+
+	@property
+	def depth(self):
+		return max((source[0].depth for source in list(self.sources.values())), default=0)
+
+	@property
+	def depth_bytes(self):
+		return self.depth * 2
+
+	@property
+	def dropped_bytes(self):
+		return self._removed_dropped + sum(source[0].dropped_bytes for source in list(self.sources.values()))
+
+	@property
+	def received_bytes(self):
+		return self._removed_received + sum(source[0].received_bytes for source in list(self.sources.values()))
+
+	def write(self, data, address=None):
+		source = self.sources.get(address)
+		if source is None:
+			with self._lock:
+				gain = self.gains.get(f"{address[0]}:{address[1]}", self.gains.get(address[0], 1.0)) if address else 1.0
+				source = self.sources[address] = [AudioRingBuffer(self.capacity, self.overflow_policy), round(gain * 256), 0]
+		source[2] = time.monotonic()
+		return source[0].write(data)
+
+	def read(self, count):
+		"""Remove and return count mixed samples, or None if it is not time yet.
+
+		A lone sender's audio is a view of its AudioRingBuffer, as from
+		AudioRingBuffer.read(); a mix is a new array, since the frame is
+		queued while the next one is mixed.
+		"""
+		now = time.monotonic()
+		with self._lock:
+			for address, source in list(self.sources.items()):
+				if source[0].depth == 0 and now - source[2] > self.idle_timeout:
+					self._removed_dropped += source[0].dropped_bytes
+					self._removed_received += source[0].received_bytes
+					del self.sources[address]
+			sources = list(self.sources.values())
+		if len(sources) == 1 and sources[0][1] == 256:
+			return sources[0][0].read(count)
+		lead = max((source[0].depth for source in sources), default=0)
+		if lead < count:
+			return None
+		if lead < count + self.max_delay_samples:
+			for buffer, gain, written in sources:
+				if buffer.depth < count and now - written < self.max_delay:
+					return None  # a frame from this sender is on its way
+		if len(self._mix) != count:
+			self._mix = np.zeros(count, dtype=np.int32)
+			self._scaled = np.zeros(count, dtype=np.int32)
+		self._mix[:] = 0
+		for buffer, gain, written in sources:
+			available = min(buffer.depth, count)
+			if available == 0:
+				continue
+			data = buffer.read(available)
+			if gain == 256:
+				self._mix[:available] += data
+			else:
+				scaled = self._scaled[:available]
+				np.multiply(data, gain, out=scaled, dtype=np.int32)
+				scaled >>= 8
+				self._mix[:available] += scaled
+		np.clip(self._mix, -32768, 32767, out=self._mix)
+		return self._mix.astype(np.int16)
+
+	def clear(self):
+		with self._lock:
+			for source in self.sources.values():
+				source[0].clear()
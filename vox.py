@@ -0,0 +1,64 @@
+from collections import deque
+from math import ceil
+import numpy as np
+
+PEAK = "peak"
+RMS = "rms"
+
+
+class Vox:
+	"""Voice operated switch for int16 audio frames.
+
+	detect() is called with each frame while the VOX is closed.  It opens
+	once the level reaches threshold for attack_time, and keeps the last
+	preroll seconds of audio (including the frames that opened it) so the
+	start of the first word can be sent with the stream.  While open,
+	is_audio() says whether a frame holds the VOX open; it compares against
+	release_threshold, normally lower than threshold so a signal hovering
+	around threshold does not chop the stream.  How long the VOX stays open
+	after the last audio (vox_silence_time) is left to the caller, as frames
+	may stop arriving altogether.
+	"""
+
+	def __init__(self, threshold, release_threshold=None, detector=PEAK, attack_time=0, preroll=0, frame_seconds=0.06):
+		if detector not in (PEAK, RMS):
+			raise ValueError("unknown detector " + str(detector))
+		self.threshold = threshold
+		self.release_threshold = threshold if release_threshold is None else release_threshold
+		self.detector = detector
+		self.attack_frames = max(1, ceil(attack_time / frame_seconds - 1e-9))
+		self._frames = deque(maxlen=max(self.attack_frames, ceil(preroll / frame_seconds - 1e-9) + 1))
+		self._attack = 0
+
+	def level(self, frame):
+		if len(frame) == 0:
+			return 0
+		if self.detector == RMS:
+			samples = frame.astype(np.float32)
+			return float(np.sqrt(np.dot(samples, samples) / len(samples)))
+		# max and min instead of abs() so -32768 doesn't wrap around
+		return max(int(frame.max()), -int(frame.min()))
+
+	def detect(self, frame):
+		"""Feed a frame while closed.  Returns True when the VOX opens."""
+		if len(frame) == 0:
+			return False
+		self._frames.append(frame)
+		if self.level(frame) > self.threshold:
+			self._attack += 1
+		else:
+			self._attack = 0
+		return self._attack >= self.attack_frames
+
+	def is_audio(self, frame):
+		return self.level(frame) >= self.release_threshold
+
+	def drain(self):
+		"""Return the pre-roll frames, oldest first, and close the VOX."""
+		frames = list(self._frames)
+		self.reset()
+		return frames
+
+	def reset(self):
+		self._frames.clear()
+		self._attack = 0
@@ -0,0 +1,94 @@
+import ctypes
+import struct
+import sys
+import numpy as np
+import opuslib
+import opuslib.api
+import opuslib.api.encoder
+
+HEADER = struct.Struct(">BII")  # type (1 = audio), stream_id, packet_id
+MAX_PAYLOAD = 1275  # largest Opus packet for one 20 ms frame
+
+
+class PacketBuilder:
+	"""Encodes audio frames straight into preallocated Zello audio packets.
+
+	Each packet is written into one of a ring of slots: the 9 byte header
+	is packed in place and Opus encodes into the payload region behind it.
+	The pcm is copied into an input buffer whose pointer is made once, so
+	building a packet allocates nothing but the memoryview that is
+	returned.  A slot is only reused once nothing refers to the memoryview
+	last returned for it, so a packet may wait to be sent for as long as it
+	takes; when every slot is still held a new one is added.  Whoever keeps
+	a packet has to keep that memoryview: a slice of it is not counted.
+
+	frame() puts an already encoded payload behind a new header the same
+	way, for sending one encoded packet to several streams.
+	"""
+
+	def __init__(self, encoder, frame_size, slots=64, max_payload=MAX_PAYLOAD):
+		self.encoder = encoder
+		self.frame_size = frame_size
+		self.max_payload = max_payload
+		self._views = []  # memoryview of each slot
+		self._payloads = []  # ctypes array over each slot's payload region, for the encoder
+		self._packets = []  # memoryview last returned for each slot
+		for slot in range(slots):
+			self._add_slot()
+		self._slot = 0
+		self._packets[0] = self._views[0][:0]
+		self._unheld = self._references(0)  # what _references() counts for a packet nobody else holds
+		self._packets[0] = None
+		self._pcm = np.zeros(frame_size, dtype=np.int16)
+		self._pcm_pointer = self._pcm.ctypes.data_as(opuslib.api.c_int16_pointer)
+
+	def frame(self, stream_id, payload, packet_id=0):
+		"""Copy an Opus payload into the next slot behind a header and return the packet as a memoryview."""
+		slot = self._next_slot()
+		view = self._views[slot]
+		HEADER.pack_into(view, 0, 1, stream_id, packet_id)
+		length = len(payload)
+		view[HEADER.size:HEADER.size + length] = payload
+		return self._hand_out(slot, HEADER.size + length)
+
+	def build(self, stream_id, pcm, packet_id=0):
+		"""Encode one frame of int16 pcm and return the packet as a memoryview."""
+		if len(pcm) == self.frame_size:
+			self._pcm[:] = pcm
+		else:  # pad or cut, Opus only takes whole frames
+			self._pcm[:] = 0
+			self._pcm[:len(pcm)] = pcm[:self.frame_size]
+		slot = self._next_slot()
+		HEADER.pack_into(self._views[slot], 0, 1, stream_id, packet_id)
+		length = opuslib.api.encoder.libopus_encode(
+			self.encoder,
+			self._pcm_pointer,
+			self.frame_size,
+			self._payloads[slot],
+			self.max_payload,
+		)
+		if length < 0:
+			raise opuslib.OpusError('Opus Encoder returned result="{}"'.format(length))
+		return self._hand_out(slot, HEADER.size + length)
+
+	def _hand_out(self, slot, length):
+		packet = self._packets[slot] = self._views[slot][:length]
+		return packet
+
+	def _references(self, slot):
+		return sys.getrefcount(self._packets[slot])
+
+	def _next_slot(self):
+		for _ in range(len(self._packets)):
+			slot = self._slot
+			self._slot = (slot + 1) % len(self._packets)
+			if self._packets[slot] is None or self._references(slot) <= self._unheld:
+				return slot
+		self._add_slot()  # every packet is still queued or being sent
+		return len(self._packets) - 1
+
+	def _add_slot(self):
+		buffer = bytearray(HEADER.size + self.max_payload)
+		self._views.append(memoryview(buffer))
+		self._payloads.append((ctypes.c_char * self.max_payload).from_buffer(buffer, HEADER.size))
+		self._packets.append(None)
@@ -1,29 +1,65 @@
+import time
+import_started = time.perf_counter()
 import sys
-import subprocess
+import argparse
+import asyncio
 import websocket
 import socket
+import struct
 import json
-import time
 import logging
-import pyaudio
-from numpy import frombuffer, array, repeat, short, float32
+from numpy import frombuffer, short
 import opuslib
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA256
 import base64
-from threading import Thread,Lock
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 import os
-import librosa
+from resampler import StreamResampler
+from udpbuffer import AudioRingBuffer, SourceMixer, DROP_OLDEST, DROP_NEWEST
+from jitterbuffer import JitterBuffer
+from vox import Vox
+from zellopacket import PacketBuilder, HEADER, MAX_PAYLOAD
+from ptt import PttController, ShellBackend, ProcessBackend, FileBackend
+from metrics import MetricsRegistry, start_http_server
+from archive import Archiver
+from mixer import Mixer
+from sendqueue import SendQueue
+from audiofile import playlist, file_blocks, stream_blocks, BLOCK_BYTES
 
 logging.basicConfig(format='%(asctime)s %(levelname).1s %(funcName)s: %(message)s', level=logging.INFO)
 LOG = logging.getLogger('Zellostream')
 
+# PyAudio, pulsectl and pycryptodome are imported only by the code paths that need them, see start_audio() and get_config()
 
-
-if os.name != 'nt':  #'nt' is Windows
-	from pulseaudio import PulseAudioHandler
+metrics = MetricsRegistry()
+udp_buffer_depth = metrics.gauge("zellostream_udp_buffer_depth_bytes", "Audio waiting in the UDP buffer", ("tgid",))
+udp_dropped_bytes = metrics.counter("zellostream_udp_dropped_bytes_total", "Audio dropped because the UDP buffer was full", ("tgid",))
+udp_received_bytes = metrics.counter("zellostream_udp_received_bytes_total", "UDP bytes received", ("tgid",))
+udp_received_packets = metrics.counter("zellostream_udp_received_packets_total", "UDP datagrams received", ("tgid",))
+udp_sources = metrics.gauge("zellostream_udp_sources", "Senders whose UDP audio is being mixed", ("tgid",))
+frames_encoded = metrics.counter("zellostream_frames_encoded_total", "Audio frames encoded", ("channel",))
+packets_sent = metrics.counter("zellostream_packets_sent_total", "Audio packets sent to Zello", ("channel",))
+send_failures = metrics.counter("zellostream_send_failures_total", "Failed websocket sends", ("channel",))
+send_stalls = metrics.counter("zellostream_send_stalls_total", "Websocket sends that timed out after zello_send_timeout because the uplink stalled, ending the connection", ("channel",))
+send_queue_depth = metrics.gauge("zellostream_send_queue_depth", "Audio packets waiting to be sent to Zello", ("channel",))
+send_dropped = metrics.counter("zellostream_send_dropped_total", "Audio packets dropped before sending, too old (stale) or too many waiting (overflow)", ("channel", "reason"))
+send_latency = metrics.histogram("zellostream_send_latency_seconds", "Time from queueing an audio packet to the websocket accepting it", ("channel",))
+start_stream_seconds = metrics.histogram("zellostream_start_stream_seconds", "Time from sending start_stream to receiving the stream_id", ("channel",))
+stream_rollovers = metrics.counter("zellostream_stream_rollovers_total", "Streams restarted at the stream length limit", ("channel",))
+reconnects = metrics.counter("zellostream_reconnects_total", "Zello connections re-established after being lost", ("channel",))
+keyup_seconds = metrics.histogram("zellostream_keyup_seconds", "Time from the VOX opening to the first audio packet sent", ("channel",))
+decode_errors = metrics.counter("zellostream_decode_errors_total", "Received packets that could not be decoded", ("channel",))
+rx_packets = metrics.counter("zellostream_rx_packets_total", "Packets received from Zello, by jitter buffer outcome", ("channel", "outcome"))
+capture_buffer_depth = metrics.gauge("zellostream_capture_buffer_depth_bytes", "Sound card audio waiting to be encoded")
+capture_dropped_bytes = metrics.counter("zellostream_capture_dropped_bytes_total", "Sound card audio dropped because the capture buffer was full")
+capture_overflows = metrics.counter("zellostream_capture_overflows_total", "Sound card reads that failed with an input overflow")
+stage_seconds = metrics.histogram("zellostream_stage_seconds", "Processing time per frame of each pipeline stage", ("stage",))
+capture_stage = stage_seconds.labels("capture")
+resample_stage = stage_seconds.labels("resample")
+encode_stage = stage_seconds.labels("encode")
+send_stage = stage_seconds.labels("send")
+decode_stage = stage_seconds.labels("decode")
 
 """On Windows, requires these DLL files in the same directory:
 opus.dll (renamed from libopus-0.dll)
@@ -32,18 +68,50 @@ libgcc_s_sjlj-1.dll
 These can be obtained from the 'opusfile' download at http://opus-codec.org/downloads/
 """
 
-seq_num = 0
-
-
 class ConfigException(Exception):
 	pass
 
 
-def get_config():
-	config = {}
+class EndOfInput(Exception):
+	"""The audio file or stdin has been played to the end."""
+
+
+class StartupProfile:
+	"""Wall clock time spent in each startup phase, reported with --startup-profile."""
+
+	def __init__(self):
+		self.phases = []
+
+	def add(self, name, seconds):
+		self.phases.append((name, seconds))
+
+	@contextmanager
+	def phase(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - start)
+
+	def report(self):
+		print("startup profile:")
+		for name, seconds in self.phases:
+			print(f"  {name:<40} {seconds * 1000:8.1f} ms")
+		print(f"  {'ready after':<40} {(time.perf_counter() - import_started) * 1000:8.1f} ms")
+
 
-	with open("config.json") as f:
+startup = StartupProfile()
+startup.add("module imports", time.perf_counter() - import_started)
+
+
+def get_config(filename="config.json"):
+	with open(filename) as f:
 		configdata = json.load(f)
+	return parse_config(configdata)
+
+
+def parse_config(configdata):
+	config = {}
 
 	username = configdata.get("username")
 	if not username:
@@ -56,9 +124,19 @@ def get_config():
 	zello_channel = configdata.get("zello_channel")
 	if not zello_channel:
 		raise ConfigException("ERROR GETTING ZELLO CHANNEL NAME FROM CONFIG FILE")
-	config["zello_channel"] = zello_channel
+	# one channel, or a list of channels that all get the same audio
+	config["zello_channels"] = [zello_channel] if isinstance(zello_channel, str) else list(zello_channel)
+	config["zello_channel"] = config["zello_channels"][0]
 	config["vox_silence_time"] = configdata.get("vox_silence_time", 3)
 	config["audio_threshold"] = configdata.get("audio_threshold", 1000)
+	config["vox_release_threshold"] = configdata.get("vox_release_threshold", config["audio_threshold"])
+	config["vox_detector"] = configdata.get("vox_detector", "peak")
+	if config["vox_detector"] not in ("peak", "rms"):
+		raise ConfigException("UNKNOWN vox_detector " + str(config["vox_detector"]))
+	config["vox_attack_time"] = configdata.get("vox_attack_time", 0)
+	config["vox_preroll"] = configdata.get("vox_preroll", 0.3)
+	config["stream_rollover_time"] = configdata.get("stream_rollover_time", 30)
+	config["stream_rollover_window"] = configdata.get("stream_rollover_window", 5)
 	config["input_device_index"] = configdata.get("input_device_index", 0)
 	config["input_pulse_name"] = configdata.get("input_pulse_name")
 	config["output_device_index"] = configdata.get("output_device_index", 0)
@@ -66,40 +144,130 @@ def get_config():
 	config["audio_input_sample_rate"] = configdata.get("audio_input_sample_rate", 48000)
 	config["audio_input_channels"] = configdata.get("audio_input_channels", 1)
 	config["zello_sample_rate"] = configdata.get("zello_sample_rate", 16000)
+	config["opus_application"] = configdata.get("opus_application", "audio")
+	if config["opus_application"] not in OPUS_APPLICATIONS:
+		raise ConfigException("UNKNOWN opus_application " + str(config["opus_application"]))
+	config["opus_bitrate"] = configdata.get("opus_bitrate")
+	config["opus_complexity"] = configdata.get("opus_complexity")
+	config["opus_dtx"] = configdata.get("opus_dtx", False)
+	config["opus_frame_size"] = configdata.get("opus_frame_size", 60)
+	if config["opus_frame_size"] not in (20, 40, 60):
+		raise ConfigException("opus_frame_size MUST BE 20, 40 OR 60")
+	config["opus_frames_per_packet"] = configdata.get("opus_frames_per_packet", 1)
+	if config["opus_frames_per_packet"] not in (1, 2):
+		raise ConfigException("opus_frames_per_packet MUST BE 1 OR 2")
+	config["packet_seconds"] = config["opus_frame_size"] * config["opus_frames_per_packet"] / 1000
 	config["audio_output_sample_rate"] = configdata.get("audio_output_sample_rate", 48000)
 	config["audio_output_channels"] = configdata.get("audio_output_channels", 1)
 	config["audio_output_volume"] = configdata.get("audio_output_volume", 1)
+	config["jitter_min_delay"] = configdata.get("jitter_min_delay", 0.06)
+	config["jitter_max_delay"] = configdata.get("jitter_max_delay", 0.5)
+	config["rx_channels"] = configdata.get("rx_channels", {})
+	config["rx_duck_gain"] = configdata.get("rx_duck_gain", 0.25)
 	config["in_channel_config"] = configdata.get("in_channel", "mono")
 	config["audio_source"] = configdata.get("audio_source","Sound Card")
+	if config["audio_source"] not in ("Sound Card", "UDP", "File", "Stdin", "None"):
+		raise ConfigException("audio_source MUST BE Sound Card, UDP, File, Stdin OR None")
+	config["audio_file"] = configdata.get("audio_file")
+	if config["audio_source"] == "File" and not config["audio_file"]:
+		raise ConfigException("audio_source File NEEDS audio_file")
+	config["input_pacing"] = configdata.get("input_pacing", "realtime")
+	if config["input_pacing"] not in ("realtime", "fast"):
+		raise ConfigException("input_pacing MUST BE realtime OR fast")
 	config["ptt_on_command"] = configdata.get("ptt_on_command")
 	config["ptt_off_command"] = configdata.get("ptt_off_command")
 	config["ptt_off_delay"] =  configdata.get("ptt_off_delay", 2)
 	config["ptt_command_support"] = not (config["ptt_on_command"] is None or config["ptt_off_command"] is None)
+	config["ptt_backend"] = configdata.get("ptt_backend", "shell")
+	config["ptt_process_command"] = configdata.get("ptt_process_command")
+	config["ptt_device"] = configdata.get("ptt_device")
+	if config["ptt_command_support"]:
+		if config["ptt_backend"] == "process" and not config["ptt_process_command"]:
+			raise ConfigException("ERROR GETTING ptt_process_command FOR ptt_backend process")
+		if config["ptt_backend"] == "file" and not config["ptt_device"]:
+			raise ConfigException("ERROR GETTING ptt_device FOR ptt_backend file")
+		if config["ptt_backend"] not in ("shell", "process", "file"):
+			raise ConfigException("UNKNOWN ptt_backend " + str(config["ptt_backend"]))
 	config["logging_level"] = configdata.get("logging_level", "warning")
+	config["relays"] = []
+	for relay in configdata.get("relays", []):
+		if not isinstance(relay, dict) or not relay.get("from") or not relay.get("to") or relay["from"] == relay["to"]:
+			raise ConfigException("EACH OF relays NEEDS DIFFERENT from AND to CHANNELS")
+		config["relays"].append((relay["from"], relay["to"]))
+	config["archive_dir"] = configdata.get("archive_dir")
+	config["metrics_port"] = configdata.get("metrics_port")
+	config["metrics_json_file"] = configdata.get("metrics_json_file")
+	config["metrics_interval"] = configdata.get("metrics_interval", 10)
 	config["udp_port"] = configdata.get("UDP_PORT",9123)
 	config["tgid_in_stream"] = configdata.get("TGID_in_stream",False)
 	config["tgid_to_play"] = configdata.get("TGID_to_play",70000)
+	tgid_channels = configdata.get("TGID_channels")
+	if tgid_channels:
+		# only UDP audio carries TGIDs: routes sharing one capture buffer would not all be woken
+		if config["audio_source"] != "UDP":
+			raise ConfigException("TGID_channels REQUIRES audio_source UDP")
+		if not config["tgid_in_stream"]:
+			raise ConfigException("TGID_channels REQUIRES TGID_in_stream TO BE TRUE")
+		config["tgid_channels"] = {int(tgid): [channel] if isinstance(channel, str) else list(channel) for tgid, channel in tgid_channels.items()}
+	else:
+		config["tgid_channels"] = None
+	config["udp_buffer_seconds"] = configdata.get("udp_buffer_seconds", 10)
+	config["capture_buffer_seconds"] = configdata.get("capture_buffer_seconds", 2)
+	config["udp_overflow_policy"] = configdata.get("udp_overflow_policy", "drop_oldest")
+	if config["udp_overflow_policy"] not in (DROP_OLDEST, DROP_NEWEST):
+		raise ConfigException("udp_overflow_policy MUST BE drop_oldest OR drop_newest")
+	config["udp_receive_buffer"] = configdata.get("udp_receive_buffer")
+	config["udp_batch"] = configdata.get("udp_batch", 64)
+	config["udp_mix"] = configdata.get("udp_mix", True)
+	config["udp_mix_delay"] = configdata.get("udp_mix_delay", 0.1)
+	config["udp_source_timeout"] = configdata.get("udp_source_timeout", 2)
+	config["udp_source_gains"] = configdata.get("udp_source_gains", {})
 	zello_work = configdata.get("zello_work_account_name")
+	config["zello_work"] = bool(zello_work)
+	config["zello_keepalive"] = configdata.get("zello_keepalive", 20)
+	config["zello_reconnect_max_delay"] = configdata.get("zello_reconnect_max_delay", 30)
+	config["zello_send_max_age"] = configdata.get("zello_send_max_age", 1.0)
+	config["zello_send_timeout"] = configdata.get("zello_send_timeout", 10)
 	if zello_work:
-		config["zello_ws_url"] = "wss://zellowork.io/ws/" + zello_work
+		config["zello_ws_url"] = configdata.get("zello_ws_url", "wss://zellowork.io/ws/" + zello_work)
 	else:
-		config["zello_ws_url"] = "wss://zello.io/ws"
+		config["zello_ws_url"] = configdata.get("zello_ws_url", "wss://zello.io/ws")
 
 		issuer = configdata.get("issuer")
 		if not issuer:
 			raise ConfigException("ERROR GETTING ZELLO ISSUER ID FROM CONFIG FILE")
 		config["issuer"] = issuer
 
+		with startup.phase("import pycryptodome"):
+			from Crypto.PublicKey import RSA
 		f = open("privatekey.pem", "r")
 		config["key"] = RSA.import_key(f.read())
 		f.close()
 	return config
 
 
-def create_zello_jwt(config):
+JWT_LIFETIME = 60  # seconds
+JWT_REFRESH_MARGIN = 20  # make a new token when the cached one has less than this left
+
+jwt_cache = {}  # issuer: (jwt, exp)
+
+
+def get_zello_jwt(config):
+	# signing is slow, so reuse a token until it is close to expiring
+	jwt, exp = jwt_cache.get(config["issuer"], (None, 0))
+	if exp - time.time() < JWT_REFRESH_MARGIN:
+		exp = round(time.time() + JWT_LIFETIME)
+		jwt = create_zello_jwt(config, exp)
+		jwt_cache[config["issuer"]] = (jwt, exp)
+	return jwt
+
+
+def create_zello_jwt(config, exp=None):
 	# Create a Zello-specific JWT.  Can't use PyJWT because Zello doesn't support url safe base64 encoding in the JWT.
+	from Crypto.Signature import pkcs1_15
+	from Crypto.Hash import SHA256
 	header = {"typ": "JWT", "alg": "RS256"}
-	payload = {"iss": config["issuer"], "exp": round(time.time() + 60)}
+	payload = {"iss": config["issuer"], "exp": exp or round(time.time() + JWT_LIFETIME)}
 	signer = pkcs1_15.new(config["key"])
 	json_header = json.dumps(header, separators=(",", ":"), cls=None).encode("utf-8")
 	json_payload = json.dumps(payload, separators=(",", ":"), cls=None).encode("utf-8")
@@ -138,10 +306,13 @@ def get_default_output_audio_index(config, p):
 
 
 def start_audio(config, p):
-	audio_chunk = int(config["audio_input_sample_rate"] * 0.06)  # 60ms = 960 samples @ 16000 S/s
+	audio_chunk = int(config["audio_input_sample_rate"] * config["packet_seconds"])  # 60ms = 960 samples @ 16000 S/s
+	import pyaudio
 	format = pyaudio.paInt16
 	LOG.debug("open audio")
 	if (config["input_pulse_name"] != None or config["output_pulse_name"] != None) and os.name != 'nt': # using pulseaudio
+		with startup.phase("import pulsectl"):
+			from pulseaudio import PulseAudioHandler
 		pulse = PulseAudioHandler()
 	# Audio input
 	if config["input_pulse_name"] != None and os.name != 'nt': # using pulseaudio for input
@@ -157,26 +328,9 @@ def start_audio(config, p):
 		input_device_index=input_device_index,
 	)
 	LOG.debug("audio input opened")
-	if config["input_pulse_name"] != None and os.name != 'nt': # redirect input to zellostream with pulseaudio
-		LOG.error("input_pulse_name is %s",config["input_pulse_name"])
-		pulse_source_index = pulse.get_source_index(config["input_pulse_name"])
-		pulse_source_output_index = pulse.get_own_source_output_index()
-		if pulse_source_index is None or pulse_source_output_index is None:
-			LOG.warning(
-				"cannot move source output %d to source %d",
-				pulse_source_output_index,
-				pulse_source_index
-			)
-		else:
-			try:
-				pulse.move_source_output(pulse_source_output_index, pulse_source_index)
-				LOG.debug(
-					"moved pulseaudio source output %d to source %d",
-					pulse_source_output_index,
-					pulse_source_index
-				)
-			except Exception as ex:
-				LOG.error("exception assigning pulseaudio source: %s", ex)
+	if config["input_pulse_name"] != None and os.name != 'nt': # redirect input to zellostream with pulseaudio, also whenever the source comes back
+		LOG.info("input_pulse_name is %s",config["input_pulse_name"])
+		pulse.route_source_output(config["input_pulse_name"])
 	# Audio outpput
 	if config["output_pulse_name"] != None and os.name != 'nt': # using pulseaudio for output
 		output_device_index = get_default_output_audio_index(config, p)
@@ -191,82 +345,124 @@ def start_audio(config, p):
 		output_device_index=output_device_index,
 	)
 	LOG.debug("audio output opened")
-	if config["output_pulse_name"] != None and os.name != 'nt': # redirect output from zellostream with pulseaudio
-		LOG.error("output_pulse_name is %s",config["output_pulse_name"])
-		pulse_sink_index = pulse.get_sink_index(config["output_pulse_name"])
-		pulse_sink_input_index = pulse.get_own_sink_input_index()
-		if pulse_sink_index is None or pulse_sink_input_index is None:
-			LOG.warning(
-				"cannot move pulseaudio sink input %d to sink %d",
-				pulse_sink_input_index,
-				pulse_sink_index
-			)
-		else:
-			try:
-				pulse.move_sink_input(pulse_sink_input_index, pulse_sink_index)
-				LOG.debug(
-					"moved pulseaudio sink input %d to sink %d",
-					pulse_sink_input_index,
-					pulse_sink_index
-				)
-			except Exception as ex:
-				LOG.error("exception assigning pulseaudio sink: %s", ex)
+	if config["output_pulse_name"] != None and os.name != 'nt': # redirect output from zellostream with pulseaudio, also whenever the sink comes back
+		LOG.info("output_pulse_name is %s",config["output_pulse_name"])
+		pulse.route_sink_input(config["output_pulse_name"])
 	return input_stream, output_stream
 
 
-def record_chunk(config, stream, channel="mono"):
-	audio_chunk = int(config["audio_input_sample_rate"] * 0.06)
-	alldata = bytearray()
-	data = stream.read(audio_chunk)
-	alldata.extend(data)
-	data = frombuffer(alldata, dtype=short)
-	
-	if channel == "left":
-		zello_data = data[0::2]
-	elif channel == "right":
-		zello_data = data[1::2]
-	elif channel == "mix":
-		zello_data = (data[0::2] + data[1::2]) / 2
+def create_capture_buffer(config):
+	capacity = int(config["capture_buffer_seconds"] * config["audio_input_sample_rate"] * config["audio_input_channels"])
+	capture_buffer = AudioRingBuffer(capacity)
+	capture_buffer_depth.set_function(lambda: capture_buffer.depth_bytes)
+	capture_dropped_bytes.set_function(lambda: capture_buffer.dropped_bytes)
+	return capture_buffer
+
+def capture_rx(stream, config, capture_buffer, notify):
+	# drain the sound card in its own thread, however long the network side takes
+	audio_chunk = int(config["audio_input_sample_rate"] * config["packet_seconds"])
+	while processing:
+		try:
+			data = stream.read(audio_chunk)
+		except OSError as ex:  # PyAudio input overflow, the chunk is lost
+			capture_overflows.inc()
+			LOG.warning("audio input overflow: %s", ex)
+			continue
+		capture_buffer.write(data)
+		notify()
+
+def create_udp_buffers(config):
+	# one buffer per talkgroup that is played, or a single buffer keyed None when there is no TGID in the stream
+	channels = 1 if config["in_channel_config"] == "mono" else 2
+	capacity = int(config["udp_buffer_seconds"] * config["audio_input_sample_rate"] * channels)
+	if config["tgid_channels"]:
+		tgids = list(config["tgid_channels"])
+	elif config["tgid_in_stream"]:
+		tgids = [config["tgid_to_play"]]
 	else:
-		zello_data = data
-	if config["audio_input_sample_rate"] != config["zello_sample_rate"]:
-		zello_data = librosa.resample(zello_data.astype(float32), orig_sr=config["audio_input_sample_rate"], target_sr=config["zello_sample_rate"]).astype(short)
-	return zello_data
+		tgids = [None]
+	# each sender to a talkgroup is buffered on its own and mixed with the others, see SourceMixer
+	delay_samples = int(config["udp_mix_delay"] * config["audio_input_sample_rate"] * channels)
+	buffers = {tgid: SourceMixer(capacity, config["udp_overflow_policy"], delay_samples, config["udp_mix_delay"], config["udp_source_timeout"], config["udp_source_gains"]) for tgid in tgids}
+	for tgid, udp_buffer in buffers.items():
+		label = tgid_label(tgid)
+		udp_sources.labels(label).set_function(lambda udp_buffer=udp_buffer: len(udp_buffer.sources))
+		udp_buffer_depth.labels(label).set_function(lambda udp_buffer=udp_buffer: udp_buffer.depth_bytes)
+		udp_dropped_bytes.labels(label).set_function(lambda udp_buffer=udp_buffer: udp_buffer.dropped_bytes)
+	return buffers
+
+def tgid_label(tgid):
+	return "all" if tgid is None else str(tgid)
+
+TGID = struct.Struct("<I")  # talkgroup ID ahead of the audio in trunk-recorder datagrams
+
+def open_udp_socket(config):
+	sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+	if config["udp_receive_buffer"]:
+		# room for bursts while the receive thread waits for the GIL
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config["udp_receive_buffer"])
+		LOG.info("UDP receive buffer %d bytes", sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+	sock.settimeout(.5)
+	sock.bind(("",config["udp_port"]))
+	return sock
 
-def udp_rx(sock,config):
-	global udpdata
+def udp_rx(sock,config,notify):
+	# wait for one datagram, then drain whatever else the socket holds without blocking, up to udp_batch
+	# datagrams, and account and notify once per talkgroup for the whole batch
+	packet = bytearray(4096)
+	view = memoryview(packet)
+	tgid_in_stream = config['tgid_in_stream']
+	batch_size = config["udp_batch"]
+	mix = config["udp_mix"]
+	timeout = sock.gettimeout()
+	counters = {}  # tgid -> (packets, bytes) metric values
 	while processing:
+		received = {}  # tgid -> [packets, bytes] in this batch
 		try:
-			newdata,addr = sock.recvfrom(4096)
-			if config['tgid_in_stream']:
-				if len(newdata) > 0:
-					tgid = int.from_bytes(newdata[0:4],"little")
-					LOG.debug("got %d bytes from %s for TGID %d", len(newdata), addr, tgid)
-					if tgid == config['tgid_to_play']:
-						newdata = newdata[4:]
-					else:
-						newdata = b''
-			else:
-				if len(newdata) > 0:
-					LOG.debug("got %d bytes from %s", len(newdata), addr)
-			with udp_buffer_lock:
-				udpdata = udpdata + newdata
-		except socket.timeout:
+			nbytes, address = sock.recvfrom_into(packet)
+			# a socket with a timeout polls before every read, so drain it in non-blocking mode
+			sock.settimeout(0)
+			for count in range(1, batch_size + 1):
+				if not mix:
+					address = None  # all senders share one buffer, their datagrams interleaved
+				tgid = TGID.unpack_from(packet)[0] if tgid_in_stream and nbytes >= 4 else None
+				totals = received.get(tgid)
+				if totals is None:
+					totals = received[tgid] = [0, 0]
+				totals[0] += 1
+				totals[1] += nbytes
+				if tgid_in_stream:
+					udp_buffer = udp_buffers.get(tgid)
+					if udp_buffer and nbytes > 4:
+						udp_buffer.write(view[4:nbytes], address)
+				elif nbytes > 0:
+					udp_buffers[None].write(view[:nbytes], address)
+				if count < batch_size:
+					nbytes, address = sock.recvfrom_into(packet)
+		except (BlockingIOError, socket.timeout):
 			pass
+		finally:
+			sock.settimeout(timeout)
+		for tgid, (packets, nbytes) in received.items():
+			counter = counters.get(tgid)
+			if counter is None:
+				counter = counters[tgid] = (udp_received_packets.labels(tgid_label(tgid)), udp_received_bytes.labels(tgid_label(tgid)))
+			counter[0].inc(packets)
+			counter[1].inc(nbytes)
+			LOG.debug("got %d packets, %d bytes for TGID %s", packets, nbytes, tgid)
+			if tgid in udp_buffers:
+				notify(tgid)
 
-def get_udp_audio(config,seconds,channel="mono"):
-	global udpdata,udp_buffer_lock
-	num_bytes = int(seconds*config["audio_input_sample_rate"]*2)  #.06 seconds * 8000 samples per second * 2 bytes per sample => 960 bytes per 60 ms
+def read_audio(config,audio_buffer,seconds,channel="mono",resampler=None):
+	num_samples = int(seconds*config["audio_input_sample_rate"])  #.06 seconds * 8000 samples per second => 480 samples (960 bytes) per 60 ms
 	if channel != "mono":
-		num_bytes = num_bytes *2
-	with udp_buffer_lock: 
-		#print(udpdata[:num_bytes])
-		data = frombuffer(udpdata[:num_bytes], dtype=short)
-		if len(data) == num_bytes/2:
-			udpdata = udpdata[num_bytes:]
-			print("getting audio udpdata length is ",len(udpdata))
-		else:
-			data = b''
+		num_samples = num_samples *2
+	started = time.perf_counter()
+	data = audio_buffer.read(num_samples)
+	if data is None:
+		data = frombuffer(b'', dtype=short)
+	else:
+		LOG.debug("buffer depth %d bytes, %d bytes dropped", audio_buffer.depth_bytes, audio_buffer.dropped_bytes)
 	if channel == "left":
 		zello_data = data[0::2]
 	elif channel == "right":
@@ -275,21 +471,28 @@ def get_udp_audio(config,seconds,channel="mono"):
 		zello_data = (data[0::2] + data[1::2]) / 2
 	else:
 		zello_data = data
-	if len(zello_data) > 0 and config["audio_input_sample_rate"] != config["zello_sample_rate"]:
-		zello_data = librosa.resample(zello_data.astype(float32), orig_sr=config["audio_input_sample_rate"], target_sr=config["zello_sample_rate"]).astype(short)
+	if len(zello_data) == 0:
+		return zello_data
+	captured = time.perf_counter()
+	capture_stage.observe(captured - started)
+	if resampler:
+		zello_data = resampler.resample(zello_data)
+		resample_stage.observe(time.perf_counter() - captured)
+	if zello_data.base is not None:
+		zello_data = zello_data.copy() # frames are queued, don't hand out views of the ring buffer
 	return zello_data
 
 def create_zello_connection(config):
 	try:
 		ws = websocket.create_connection(config["zello_ws_url"])
-		ws.settimeout(1)
-		global seq_num
-		seq_num = 1
+		# a send gets this long to get through a slow uplink; meanwhile the send queue drops audio that is too old
+		ws.settimeout(config["zello_send_timeout"])
+		ws.seq_num = 1  # each connection numbers its own commands
 		send = {}
 		send["command"] = "logon"
-		send["seq"] = seq_num
-		if "zellowork" not in config["zello_ws_url"]:
-			encoded_jwt = create_zello_jwt(config)
+		send["seq"] = ws.seq_num
+		if not config["zello_work"]:
+			encoded_jwt = get_zello_jwt(config)
 			send["auth_token"] = encoded_jwt.decode("utf-8")
 		send["username"] = config["username"]
 		send["password"] = config["password"]
@@ -298,67 +501,30 @@ def create_zello_connection(config):
 		result = ws.recv()
 		data = json.loads(result)
 		LOG.info("seq: %d", data.get("seq"))
-		seq_num = seq_num + 1
+		ws.seq_num = ws.seq_num + 1
 		return ws
 	except Exception as ex:
 		LOG.error("exception: %s", ex)
 		return None
 
 
-def start_stream(config, ws):
-	global seq_num
-	start_seq_num = seq_num
+def start_stream_command(config):
 	send = {}
 	send["command"] = "start_stream"
 	send["channel"] = config["zello_channel"]
-	send["seq"] = seq_num
-	seq_num = seq_num + 1
 	send["type"] = "audio"
 	send["codec"] = "opus"
 	# codec_header:
 	# base64 encoded 4 byte string: first 2 bytes for sample rate, 3rd for number of frames per packet (1 or 2), 4th for the frame size
 	# gd4BPA==  => 0x80 0x3e 0x01 0x3c  => 16000 Hz, 1 frame per packet, 60 ms frame size
-	frames_per_packet = 1
-	packet_duration = 60
 	codec_header = base64.b64encode(
-		config["zello_sample_rate"].to_bytes(2, "little") + frames_per_packet.to_bytes(1, "big") + packet_duration.to_bytes(1, "big")
+		config["zello_sample_rate"].to_bytes(2, "little")
+		+ config["opus_frames_per_packet"].to_bytes(1, "big")
+		+ config["opus_frame_size"].to_bytes(1, "big")
 	).decode()
 	send["codec_header"] = codec_header
-	send["packet_duration"] = packet_duration
-	try:
-		ws.send(json.dumps(send))
-	except Exception as ex:
-		LOG.error("send exception %s", ex)
-	while True:
-		try:
-			result = ws.recv()
-			data = json.loads(result)
-			LOG.debug("data: %s", data)
-			if "error" in data.keys():
-				LOG.warning("error %s", data["error"])
-				if seq_num > start_seq_num + 8:
-					LOG.warning("bailing out")
-					return None
-				time.sleep(0.5)
-				send["seq"] = seq_num
-				seq_num = seq_num + 1
-				ws.send(json.dumps(send))
-			if "stream_id" in data.keys():
-				stream_id = int(data["stream_id"])
-				return stream_id
-		except Exception as ex:
-			LOG.error("exception %s", ex)
-			if seq_num > start_seq_num + 8:
-				LOG.warning("bailing out")
-				return None
-			time.sleep(0.5)
-			send["seq"] = seq_num
-			seq_num = seq_num + 1
-			try:
-				ws.send(json.dumps(send))
-			except Exception as ex:
-				LOG.error("send exception %s", ex)
-				return None
+	send["packet_duration"] = config["opus_frame_size"] * config["opus_frames_per_packet"]
+	return send
 
 
 def stop_stream(ws, stream_id):
@@ -371,8 +537,19 @@ def stop_stream(ws, stream_id):
 		LOG.error("exception: %s", {ex})
 
 
+OPUS_APPLICATIONS = {"audio": opuslib.APPLICATION_AUDIO, "voip": opuslib.APPLICATION_VOIP}
+
+
 def create_encoder(config):
-	return opuslib.api.encoder.create_state(config["zello_sample_rate"], config["audio_input_channels"], opuslib.APPLICATION_AUDIO)
+	# whatever the input channels, one channel is picked or mixed down before encoding
+	enc = opuslib.api.encoder.create_state(config["zello_sample_rate"], 1, OPUS_APPLICATIONS[config["opus_application"]])
+	if config["opus_bitrate"]:
+		opuslib.api.encoder.encoder_ctl(enc, opuslib.api.ctl.set_bitrate, config["opus_bitrate"])
+	if config["opus_complexity"] is not None:
+		opuslib.api.encoder.encoder_ctl(enc, opuslib.api.ctl.set_complexity, config["opus_complexity"])
+	if config["opus_dtx"]:
+		opuslib.api.encoder.encoder_ctl(enc, opuslib.api.ctl.set_dtx, 1)
+	return enc
 
 
 def create_decoder(sample_rate):
@@ -383,83 +560,556 @@ def bytes_to_uint32(bytes):
 	return bytes[0]*(1<<24) + bytes[1]*(1<<16) + bytes[2]*(1<<8) + bytes[3]
 
 
-def run_ptt_command(msg, command_list, delay):
-	command = " ".join(command_list)
-	LOG.debug("%s after %.1f seconds", command, delay)
-	time.sleep(delay)
-	run_command = subprocess.run(command, shell=True)
-	LOG.info("%s exited with code %d", msg, run_command.returncode)
+def create_ptt_controller(config):
+	if not config["ptt_command_support"]:
+		return None
+	if config["ptt_backend"] == "process":
+		backend = ProcessBackend(config["ptt_process_command"], config["ptt_on_command"], config["ptt_off_command"])
+	elif config["ptt_backend"] == "file":
+		backend = FileBackend(config["ptt_device"], config["ptt_on_command"], config["ptt_off_command"])
+	else:
+		backend = ShellBackend(config["ptt_on_command"], config["ptt_off_command"])
+	return PttController(backend)
 
 
-def stream_to_zello(config, zello_ws, audio_input_stream, data):
-	try:
-		stream_id = start_stream(config, zello_ws)
-		if not stream_id:
-			LOG.warning("cannot start stream")
-			time.sleep(1)
-			return stream_id
-		LOG.info("sending to stream_id %d", stream_id)
-		enc = create_encoder(config)
-		zello_chunk = int(config["zello_sample_rate"] * 0.06)
-		packet_id = 0  # packet ID is only used in server to client - populate with zeros for client to server direction
-		quiet_samples = 0
-		timer = time.time()
-		while quiet_samples < (config["vox_silence_time"] * (1 / 0.06)):
-			if time.time() - timer > 30:
-				LOG.info("timer break")
-				stop_stream(zello_ws, stream_id)
-				stream_id = start_stream(config, zello_ws)
-				if not stream_id:
-					LOG.warning("cannot start stream")
-					break
-				timer = time.time()
-			if len(data) > 0:
-				data2 = data.tobytes()
-				out = opuslib.api.encoder.encode(enc, data2, zello_chunk, len(data2) * 2)
-				send_data = bytearray(array([1]).astype(">u1").tobytes())
-				send_data = send_data + array([stream_id]).astype(">u4").tobytes()
-				send_data = send_data + array([packet_id]).astype(">u4").tobytes()
-				send_data = send_data + out
+def create_vox(config):
+	return Vox(
+		config["audio_threshold"],
+		config["vox_release_threshold"],
+		config["vox_detector"],
+		config["vox_attack_time"],
+		config["vox_preroll"],
+		config["packet_seconds"],
+	)
+
+
+FRAME_QUEUE_SIZE = 100  # frames waiting to be encoded, per route
+SENDER_BACKLOG = 8  # packets a file played as fast as possible may have waiting per channel
+DRAIN_POLL_SECONDS = 0.005
+SEND_QUEUE_SIZE = 48  # audio packets waiting to be sent, per connection
+
+
+def put_dropping_oldest(queue, item):
+	if queue.full():
+		queue.get_nowait()
+	queue.put_nowait(item)
+
+
+class ZelloSession:
+	"""A websocket logged on to one Zello channel, driven from the asyncio loop.
+
+	run() keeps the connection up.  While connected, a receive task hands
+	command replies to the coroutine waiting on their seq and queues stream
+	events and binary audio on events; a send task drains outbound, which
+	drops audio that has waited longer than zello_send_max_age so a slow
+	uplink delays the audio by at most that much.
+	"""
+
+	def __init__(self, config, receive=True):
+		self.config = config
+		self.receive = receive
+		self.ws = None
+		self.connected = asyncio.Event()
+		self.events = asyncio.Queue()
+		self.outbound = SendQueue(SEND_QUEUE_SIZE, config["zello_send_max_age"])
+		self._replies = {}
+		channel = config["zello_channel"]
+		self.packets_sent = packets_sent.labels(channel)
+		self.send_failures = send_failures.labels(channel)
+		self.send_stalls = send_stalls.labels(channel)
+		self.send_latency = send_latency.labels(channel)
+		send_queue_depth.labels(channel).set_function(lambda: self.outbound.audio)
+		send_dropped.labels(channel, "stale").set_function(lambda: self.outbound.dropped_stale)
+		send_dropped.labels(channel, "overflow").set_function(lambda: self.outbound.dropped_overflow)
+		self.start_stream_seconds = start_stream_seconds.labels(channel)
+		self.reconnects = reconnects.labels(channel)
+		self.keyup_seconds = keyup_seconds.labels(channel)
+		self.keyup_started = None  # set by transmit() when the VOX opens, cleared when its first packet is sent
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		connected_before = False
+		delay = 1
+		while processing:
+			ws = await loop.run_in_executor(None, create_zello_connection, self.config)
+			if not ws:
+				LOG.warning("cannot establish connection to %s, retrying in %d s", self.config["zello_channel"], delay)
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, self.config["zello_reconnect_max_delay"])
+				continue
+			delay = 1
+			if connected_before:
+				self.reconnects.inc()
+			connected_before = True
+			self.ws = ws
+			self.outbound.clear()  # left over from the last connection
+			self.connected.set()
+			sender = asyncio.create_task(self._send_loop())
+			keepalive = asyncio.create_task(self._keepalive_loop())
+			try:
+				await self._recv_loop()
+			finally:
+				sender.cancel()
+				keepalive.cancel()
+				self.connected.clear()
+				for reply in self._replies.values():
+					if not reply.done():
+						reply.set_result(None)
+				self._replies.clear()
+				self.outbound.clear()  # nothing more will be sent on this connection; wakes senders waiting for room
 				try:
-					nbytes = zello_ws.send_binary(send_data)
+					ws.close(timeout=0.5)
+				except Exception as ex:
+					LOG.debug("close exception: %s", ex)
+
+	async def _recv_loop(self):
+		loop = asyncio.get_running_loop()
+		while self.ws.connected:
+			try:
+				received = await loop.run_in_executor(None, self.ws.recv)
+			except websocket.WebSocketTimeoutException:
+				continue
+			except Exception as ex:
+				LOG.error("recv exception: %s", ex)
+				return
+			if type(received) == bytes:
+				if self.receive:
+					self.events.put_nowait(received)
+				continue
+			if not received:
+				continue
+			LOG.debug("recv: %s", received)
+			try:
+				data = json.loads(received)
+			except ValueError:
+				LOG.warning("cannot decode %s", received)
+				continue
+			reply = self._replies.pop(data.get("seq"), None)
+			if reply:
+				if not reply.done():
+					reply.set_result(data)
+			elif self.receive and "command" in data:
+				self.events.put_nowait(data)
+
+	async def _send_loop(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			queued, message = await self.outbound.get()
+			try:
+				if type(message) == str:
+					await loop.run_in_executor(None, self.ws.send, message)
+				else:
+					started = time.perf_counter()
+					nbytes = await loop.run_in_executor(None, self.ws.send_binary, message)
+					send_stage.observe(time.perf_counter() - started)
+					self.send_latency.observe(time.perf_counter() - queued)
+					if self.keyup_started is not None:
+						keyup = time.perf_counter() - self.keyup_started
+						self.keyup_seconds.observe(keyup)
+						LOG.info("key-up to first packet sent: %.0f ms", keyup * 1000)
+						self.keyup_started = None
 					if nbytes == 0:
 						LOG.warning("binary send error")
-						break
-				except Exception as ex:
-					LOG.error("Zello error %s", ex)
-					break
-			if config["audio_source"] == "Sound Card":
-				data = record_chunk(config, audio_input_stream, channel=config["in_channel_config"])
-			elif config["audio_source"] == "UDP":
-				data = get_udp_audio(config,seconds=0.06, channel=config["in_channel_config"])
-			else:
-				data = frombuffer(b'',dtype=short)
-			if len(data) > 0:
-				max_audio_level = max(abs(data))
-			else:
-				max_audio_level = 0
-			if len(data) == 0 or max_audio_level < config["audio_threshold"]:
-				quiet_samples = quiet_samples + 1
+						self.send_failures.inc()
+					else:
+						self.packets_sent.inc()
+			except websocket.WebSocketTimeoutException:
+				# part of the frame may have been written already, so it can't be sent again on this connection
+				LOG.warning("uplink to %s stalled for %g s, reconnecting", self.config["zello_channel"], self.config["zello_send_timeout"])
+				self.send_stalls.inc()
+				self.send_failures.inc()
+				self.ws.shutdown()  # ends the receive loop so run() reconnects
+				return
+			except Exception as ex:
+				LOG.error("Zello error %s", ex)
+				self.send_failures.inc()
+				self.ws.shutdown()
+				return
+			finally:
+				self.outbound.done()
+
+	async def _keepalive_loop(self):
+		# a ping every so often stops NAT and proxies from dropping an idle connection, and finds a dead one before VOX needs it
+		loop = asyncio.get_running_loop()
+		while True:
+			await asyncio.sleep(self.config["zello_keepalive"])
+			try:
+				await loop.run_in_executor(None, self.ws.ping)
+			except Exception as ex:
+				LOG.warning("keepalive failed: %s", ex)
+				self.ws.shutdown()  # ends the receive loop so run() reconnects
+				return
+
+	async def command(self, send, timeout=1):
+		"""Send a command and return the server's reply, or None."""
+		if not self.connected.is_set():
+			return None
+		seq = self.ws.seq_num
+		self.ws.seq_num = seq + 1
+		send["seq"] = seq
+		reply = asyncio.get_running_loop().create_future()
+		self._replies[seq] = reply
+		self.outbound.put(json.dumps(send))
+		try:
+			return await asyncio.wait_for(reply, timeout)
+		except asyncio.TimeoutError:
+			return None
+		finally:
+			self._replies.pop(seq, None)
+
+	async def start_stream(self, send=None):
+		if send is None:
+			send = start_stream_command(self.config)
+		started = time.perf_counter()
+		for attempt in range(8):
+			data = await self.command(send)
+			LOG.debug("data: %s", data)
+			if data and "stream_id" in data:
+				self.start_stream_seconds.observe(time.perf_counter() - started)
+				return int(data["stream_id"])
+			if data and "error" in data:
+				LOG.warning("error %s", data["error"])
 			else:
-				quiet_samples = 0
-		LOG.info("done sending audio")
-		if stream_id:
-			stop_stream(zello_ws, stream_id)
-			stream_id = None
+				LOG.warning("no reply to start_stream")
+			await asyncio.sleep(0.5)
+		LOG.warning("bailing out")
+		return None
+
+	def stop_stream(self, stream_id):
+		send = {}
+		send["command"] = "stop_stream"
+		send["stream_id"] = stream_id
+		self.outbound.put(json.dumps(send))
+
+	def send_binary(self, data):
+		self.outbound.put(data)
+
+
+async def buffered_frames(config, audio_buffer, resampler, frames, ready):
+	# ready is set by the receiving thread (udp_rx or capture_rx) whenever audio arrives in audio_buffer
+	mixing = isinstance(audio_buffer, SourceMixer)
+	while True:
+		if mixing and len(audio_buffer.sources) > 1 and audio_buffer.depth > 0:
+			# the mixer may be holding a frame back for a sender that is behind: look again once it stops waiting
+			try:
+				await asyncio.wait_for(ready.wait(), config["udp_mix_delay"])
+			except asyncio.TimeoutError:
+				pass
+		else:
+			await ready.wait()
+		ready.clear()
+		data = read_audio(config, audio_buffer, seconds=config["packet_seconds"], channel=config["in_channel_config"], resampler=resampler)
+		while len(data) > 0:
+			put_dropping_oldest(frames, data)
+			data = read_audio(config, audio_buffer, seconds=config["packet_seconds"], channel=config["in_channel_config"], resampler=resampler)
+
+
+async def file_frames(config, blocks, resampler, frames):
+	# blocks of audio from a file or stdin go through the same chunking, channel selection and resampling as
+	# captured audio, then are handed on one frame per frame duration (realtime) or as fast as transmit() takes them
+	loop = asyncio.get_running_loop()
+	frame_samples = int(config["packet_seconds"] * config["audio_input_sample_rate"]) * (1 if config["in_channel_config"] == "mono" else 2)
+	audio_buffer = AudioRingBuffer(BLOCK_BYTES // 2 + frame_samples)
+	start = None
+	count = 0
+	while True:
+		block = await loop.run_in_executor(None, next, blocks, None)
+		if block is not None:
+			audio_buffer.write(memoryview(block).cast("B"))
+		elif audio_buffer.depth % frame_samples:
+			audio_buffer.write(bytes((frame_samples - audio_buffer.depth % frame_samples) * 2))  # pad the last frame with silence
+		while audio_buffer.depth >= frame_samples:
+			data = read_audio(config, audio_buffer, seconds=config["packet_seconds"], channel=config["in_channel_config"], resampler=resampler)
+			if config["input_pacing"] == "fast":
+				await frames.put(data)
+				continue
+			now = loop.time()
+			if start is None or now > start + (count + 1) * config["packet_seconds"]:
+				start, count = now, 0  # first frame, or the input fell behind real time (a slow pipe)
+			await asyncio.sleep(start + count * config["packet_seconds"] - now)
+			count += 1
+			put_dropping_oldest(frames, data)
+		if block is None:
+			await frames.put(None)
+			return
+
+
+def start_recording(archiver, config, direction, stream_id, packet_duration, sample_rate, sender=None):
+	if not archiver:
+		return None
+	return archiver.start(direction, config["zello_channel"], stream_id, packet_duration, sample_rate, config["route_tgid"], sender)
+
+
+class StreamSender:
+	"""Sends the packets of each transmission to one channel.
+
+	Every channel fed by a transmit pipeline has its own sender task, so its
+	start_stream handshakes, rollovers and failures never hold up the other
+	channels.  Packets queue up while it waits and are then sent at once.
+	"""
+
+	def __init__(self, config, session, archiver=None, copy=False):
+		self.config = config
+		self.session = session
+		self.archiver = archiver
+		self.queue = asyncio.Queue()
+		# a packet shared with other channels' senders is copied behind this sender's own header, otherwise sent as it is
+		self.packets = PacketBuilder(None, 0, slots=SEND_QUEUE_SIZE + 2, max_payload=MAX_PAYLOAD * round(config["packet_seconds"] / 0.02)) if copy else None
+		self.packet_duration = config["opus_frame_size"] * config["opus_frames_per_packet"]
+		self.rollovers = stream_rollovers.labels(config["zello_channel"])
+		self.active = False
+		self.stream_id = None
+		self.stream_ws = None  # connection the stream was started on
+		self.recording = None
+		self.keyup_started = None
+		self.retry_at = 0
+		self.stream_seconds = 0  # audio sent on the current stream
+		self.busy = False  # an item from queue is being handled
+
+	def open(self, keyup_started):
+		self.queue.put_nowait(("open", keyup_started, None))
+
+	def send(self, packet, quiet):
+		self.queue.put_nowait(("packet", packet, quiet))
+
+	def close(self):
+		self.queue.put_nowait(("close", None, None))
+
+	async def drain(self, limit=0):
+		"""Wait until at most limit messages are waiting to go to the channel, or the connection is lost."""
+		while self.session.connected.is_set() and self.queue.qsize() + self.busy + len(self.session.outbound) > limit:
+			await asyncio.sleep(DRAIN_POLL_SECONDS)
+
+	async def run(self):
+		try:
+			while True:
+				self.busy = False
+				op, data, quiet = await self.queue.get()
+				self.busy = True
+				if op == "open":
+					self.active = True
+					self.keyup_started = data
+					await self._start()
+				elif op == "close":
+					self.active = False
+					self._stop()
+				elif self.active:
+					await self._send(data, quiet)
+		except asyncio.CancelledError:
+			if self.stream_id and self.session.connected.is_set():
+				LOG.info("stop sending audio")
+				stop_stream(self.session.ws, self.stream_id)
+			if self.recording:
+				self.archiver.stop(self.recording)
+			raise
+
+	async def _start(self):
+		session = self.session
+		channel = self.config["zello_channel"]
+		if not session.connected.is_set():
+			LOG.warning("no connection to %s, holding audio", channel)
+			try:
+				await asyncio.wait_for(session.connected.wait(), FRAME_QUEUE_SIZE * self.config["packet_seconds"])
+			except asyncio.TimeoutError:
+				LOG.warning("still no connection to %s", channel)
+				self.retry_at = time.time() + 1
+				return
+		self.stream_id = await session.start_stream()
+		if not self.stream_id:
+			LOG.warning("cannot start stream on %s", channel)
+			self.retry_at = time.time() + 1
+			return
+		self.stream_ws = session.ws
+		LOG.info("sending to stream_id %d on %s", self.stream_id, channel)
+		self.recording = start_recording(self.archiver, self.config, "tx", self.stream_id, self.packet_duration, self.config["zello_sample_rate"])
+		if self.keyup_started is not None:
+			session.keyup_started = self.keyup_started
+			self.keyup_started = None
+		self.stream_seconds = 0
+
+	def _stop(self):
+		if self.stream_id:
+			self.session.stop_stream(self.stream_id)
+			self.stream_id = None
+		if self.recording:
+			self.archiver.stop(self.recording)
+			self.recording = None
+
+	async def _send(self, packet, quiet):
+		if not self.stream_id:
+			# the start failed or the connection dropped: try again now and then for the rest of the transmission
+			if time.time() < self.retry_at or not self.session.connected.is_set():
+				return
+			await self._start()
+			if not self.stream_id:
+				return
+		# Zello limits stream length: roll over to a new stream at a pause near the limit, or at the limit
+		# the length is counted in audio sent, which runs ahead of the clock when a file is played fast
+		elapsed = self.stream_seconds
+		if elapsed > self.config["stream_rollover_time"] or (quiet and elapsed > self.config["stream_rollover_time"] - self.config["stream_rollover_window"]):
+			LOG.info("timer break after %.1f s", elapsed)
+			self.rollovers.inc()
+			self._stop()
+			await self._start()  # packets keep queueing during the handshake and go to the new stream
+			if not self.stream_id:
+				return
+		# audio held during a handshake goes out in a burst: wait for it to be sent rather than have outbound drop it
+		await self.session.outbound.room()
+		if not self.session.connected.is_set() or self.session.ws is not self.stream_ws:
+			# a stream doesn't survive a reconnect, even one too quick to see the connection down
+			LOG.warning("connection to %s lost", self.config["zello_channel"])
+			self.stream_id = None
+			self._stop()
+			self.retry_at = time.time() + 1
+			return
+		packet_id = 0  # packet ID is only used in server to client - populate with zeros for client to server direction
+		if self.packets:
+			packet = self.packets.frame(self.stream_id, packet[HEADER.size:], packet_id)
+		else:
+			HEADER.pack_into(packet, 0, 1, self.stream_id, packet_id)
+		self.session.send_binary(packet)
+		self.stream_seconds += self.config["packet_seconds"]
+		if self.recording:
+			self.archiver.packet(self.recording, packet[HEADER.size:])
+
+
+async def transmit(config, sessions, frames, archiver=None, backpressure=False):
+	# VOX: stream to the channels from when audio crosses the threshold until vox_silence_time of quiet
+	# one packet of frames_per_packet Opus frames is encoded in a single call
+	# a None frame ends the input: transmit() returns once everything has been sent
+	# with backpressure, each packet waits for the channels to keep up instead of queueing
+	packets = PacketBuilder(
+		create_encoder(config),
+		int(config["zello_sample_rate"] * config["packet_seconds"]),
+		max_payload=MAX_PAYLOAD * round(config["packet_seconds"] / 0.02),  # libopus can make a 20 ms frame of up to MAX_PAYLOAD bytes
+	)
+	vox = create_vox(config)
+	encoded = frames_encoded.labels("+".join(config["zello_channels"]))
+	# the audio is encoded once: the first channel's sender puts its stream_id on the packet and sends it,
+	# the others copy the payload behind their own header
+	senders = [StreamSender(session.config, session, archiver, copy=index > 0) for index, session in enumerate(sessions)]
+	sender_tasks = [asyncio.create_task(sender.run()) for sender in senders]
+	try:
+		ended = False
+		while not ended:
+			data = await frames.get()
+			if data is None:
+				break
+			if not vox.detect(data):
+				continue
+			LOG.info("audio on")
+			keyup_started = time.perf_counter()
+			for sender in senders:
+				sender.open(keyup_started)
+			pending = vox.drain()  # pre-roll, ending with the frame that opened the VOX
+			# quiet is measured in audio, not wall clock time, so a file played fast ends its calls where it would in real time
+			silence = 0
+			quiet = False
+			while silence < config["vox_silence_time"]:
+				for data in pending:
+					if len(data) == 0:
+						continue
+					started = time.perf_counter()
+					packet = packets.build(0, data)
+					encode_stage.observe(time.perf_counter() - started)
+					encoded.inc()
+					if config["opus_dtx"] and len(packet) <= HEADER.size + 2:
+						continue  # DTX: the encoder says there is nothing worth sending
+					for sender in senders:
+						sender.send(packet, quiet)
+					if backpressure:
+						for sender in senders:
+							await sender.drain(SENDER_BACKLOG)
+				pending = ()
+				try:
+					# no audio coming in at all, e.g. UDP between calls, counts as silence too
+					data = await asyncio.wait_for(frames.get(), config["vox_silence_time"] - silence)
+				except asyncio.TimeoutError:
+					break
+				if data is None:
+					ended = True
+					break
+				pending = (data,)
+				quiet = not vox.is_audio(data)
+				silence = silence + config["packet_seconds"] if quiet else 0
+			LOG.info("done sending audio")
+			for sender in senders:
+				sender.close()
+		for sender in senders:
+			await sender.drain()
 	finally:
-		return stream_id
+		for task in sender_tasks:
+			task.cancel()
+		await asyncio.gather(*sender_tasks, return_exceptions=True)
+
+
+async def receive(config, session, mixer, ptt, archiver=None):
+	# several people can talk on a channel at once: each stream is decoded by its own task and mixed for playback
+	streams = {}  # stream_id: queue of its packets
+	tasks = set()
+	target_delay = config["jitter_min_delay"]  # learned by each stream, carried over to the next
 
+	def finished(task, stream_id):
+		nonlocal target_delay
+		streams.pop(stream_id, None)
+		tasks.discard(task)
+		if not task.cancelled() and task.exception() is None and task.result():
+			target_delay = task.result()
 
-def stream_from_zello(config, zello_ws, audio_output_stream, start_data):
-	if "codec_header" not in start_data:
-		return
+	try:
+		while True:
+			data = await session.events.get()
+			if type(data) == bytes:
+				packets = streams.get(bytes_to_uint32(data[1:5])) if data[0] == 1 and len(data) >= 9 else None
+				if packets:
+					packets.put_nowait(data)
+			elif data.get("command") == "on_stream_start" and "codec_header" in data:
+				stream_id = data.get("stream_id")
+				streams[stream_id] = asyncio.Queue()
+				jitter = JitterBuffer(config["jitter_min_delay"], config["jitter_max_delay"])
+				jitter.target_delay = target_delay
+				task = asyncio.create_task(receive_stream(config, streams[stream_id], data, jitter, mixer, ptt, archiver))
+				task.add_done_callback(lambda task, stream_id=stream_id: finished(task, stream_id))
+				tasks.add(task)
+			elif data.get("command") == "on_stream_stop":
+				packets = streams.get(data.get("stream_id"))
+				if packets:
+					packets.put_nowait(data)
+	finally:
+		for task in tasks:
+			task.cancel()
+
+
+async def read_stream_packets(packets, jitter, arrived):
+	# feed the jitter buffer until on_stream_stop or a second without data
+	loop = asyncio.get_running_loop()
+	while True:
+		try:
+			received = await asyncio.wait_for(packets.get(), 1)
+		except asyncio.TimeoutError:
+			LOG.warning("timeout waiting for stream data")
+			return
+		if type(received) == bytes:
+			jitter.push(bytes_to_uint32(received[5:9]), received[9:], loop.time())
+			arrived.set()
+		else:
+			LOG.info("end of bytes stream")
+			return
+
+
+async def receive_stream(config, packets, start_data, jitter, mixer, ptt, archiver=None):
+	loop = asyncio.get_running_loop()
 	packet_duration = start_data.get("packet_duration", 0)
 	b64x = base64.b64decode(start_data["codec_header"])
 	sample_rate = b64x[1]*256 + b64x[0]
 	frames_per_buffer = b64x[2]
 	frame_duration = b64x[3]
+	if not packet_duration:
+		packet_duration = frames_per_buffer * frame_duration
 	zello_chunk = (sample_rate * packet_duration) // 1000
 	dec = create_decoder(sample_rate)
+	resampler = StreamResampler(sample_rate, config["audio_output_sample_rate"])
+	errors = decode_errors.labels(config["zello_channel"])
 	LOG.info(
 		"start of bytes stream: sample_rate: %d frames_per_buffer: %d frame_duration: %d packet_duration: %d",
 		sample_rate,
@@ -467,183 +1117,333 @@ def stream_from_zello(config, zello_ws, audio_output_stream, start_data):
 		frame_duration,
 		packet_duration
 	)
-	if config["ptt_command_support"]:
-		run_ptt_command("PTT on", config["ptt_on_command"], 0)
+	jitter.reset(packet_duration)
+	recording = start_recording(archiver, config, "rx", start_data.get("stream_id"), packet_duration, sample_rate, start_data.get("from"))
+	arrived = asyncio.Event()
+	reader = asyncio.create_task(read_stream_packets(packets, jitter, arrived))
+	rx = config["rx_channels"].get(config["zello_channel"], {})
+	source = mixer.add_source(rx.get("gain", 1.0), rx.get("priority", 0))
+	if ptt:
+		ptt.key_up()
+	try:
+		# hold playout back by the target delay from the first packet, then play one packet per packet duration
+		waiter = asyncio.create_task(arrived.wait())
+		await asyncio.wait([reader, waiter], return_when=asyncio.FIRST_COMPLETED)
+		waiter.cancel()
+		start = loop.time() + jitter.target_delay
+		slot = 0
+		while not (reader.done() and jitter.depth == 0):
+			await asyncio.sleep(max(0, start + slot * jitter.packet_duration - loop.time()))
+			slot += 1
+			if jitter.depth == 0 and not reader.done():
+				# underrun: give the packet up to one more packet duration before concealing it
+				arrived.clear()
+				waiter = asyncio.create_task(arrived.wait())
+				await asyncio.wait([reader, waiter], timeout=jitter.packet_duration, return_when=asyncio.FIRST_COMPLETED)
+				waiter.cancel()
+				if reader.done() and jitter.depth == 0:
+					break
+			payload, fec = jitter.pop()
+			if recording and payload is not None and not fec:
+				archiver.packet(recording, payload)
+			started = time.perf_counter()
+			try:
+				if payload is None: # lost, let the decoder conceal it
+					audio = opuslib.api.decoder.decode(dec, None, 0, zello_chunk, False, 1)
+				else:
+					audio = opuslib.api.decoder.decode(dec, payload, len(payload), zello_chunk, fec, 1)
+			except Exception as ex:
+				LOG.error("exception decoding: %s", ex)
+				errors.inc()
+				continue
+			decode_stage.observe(time.perf_counter() - started)
+			source.write(resampler.resample(frombuffer(audio, dtype=short)))
+	finally:
+		reader.cancel()
+		source.close()
+		if recording:
+			archiver.stop(recording)
+		for outcome in ("received", "late", "lost", "recovered", "concealed", "dropped"):
+			rx_packets.labels(config["zello_channel"], outcome).inc(getattr(jitter, outcome))
+		if ptt:
+			ptt.key_down(config["ptt_off_delay"])  # also on errors and cancellation, or the transmitter stays keyed
+	LOG.info(
+		"jitter buffer totals: received %d late %d lost %d recovered by FEC %d concealed %d dropped %d target delay %d ms",
+		jitter.received,
+		jitter.late,
+		jitter.lost,
+		jitter.recovered,
+		jitter.concealed,
+		jitter.dropped,
+		jitter.target_delay * 1000
+	)
+	return jitter.target_delay
+
+
+async def dump_metrics(filename, interval):
+	loop = asyncio.get_running_loop()
 	while True:
+		await asyncio.sleep(interval)
 		try:
-			received = zello_ws.recv()
+			await loop.run_in_executor(None, metrics.dump_json, filename)
+		except OSError as ex:
+			LOG.error("cannot write metrics to %s: %s", filename, ex)
+
+
+async def refresh_jwt(config):
+	# keep a signed token ready so connecting never waits for the RSA signature
+	loop = asyncio.get_running_loop()
+	while True:
+		await loop.run_in_executor(None, get_zello_jwt, config)
+		jwt, exp = jwt_cache[config["issuer"]]
+		await asyncio.sleep(max(1, exp - JWT_REFRESH_MARGIN - time.time()))
+
+
+async def relay(source, targets):
+	# pass streams from one channel on to others as they are, without decoding
+	# streams that overlap on the source channel are relayed as separate streams, as receive() plays them
+	streams = {}  # stream_id: queue of its packets
+	tasks = set()
+
+	def finished(task, stream_id):
+		streams.pop(stream_id, None)
+		tasks.discard(task)
+
+	try:
+		while True:
+			data = await source.events.get()
+			if type(data) == bytes:
+				packets = streams.get(bytes_to_uint32(data[1:5])) if data[0] == 1 and len(data) > HEADER.size else None
+				if packets:
+					packets.put_nowait(data)
+			elif data.get("command") == "on_stream_start" and "codec_header" in data:
+				stream_id = data.get("stream_id")
+				streams[stream_id] = asyncio.Queue()
+				task = asyncio.create_task(relay_stream(source, targets, streams[stream_id], data))
+				task.add_done_callback(lambda task, stream_id=stream_id: finished(task, stream_id))
+				tasks.add(task)
+			elif data.get("command") == "on_stream_stop":
+				packets = streams.get(data.get("stream_id"))
+				if packets:
+					packets.put_nowait(data)
+	finally:
+		for task in tasks:
+			task.cancel()
+
+
+async def relay_stream(source, targets, packets, start_data):
+	send = {
+		"command": "start_stream",
+		"type": "audio",
+		"codec": "opus",
+		"codec_header": start_data["codec_header"],
+		"packet_duration": start_data.get("packet_duration", 60),
+	}
+	LOG.info("relaying stream %s from %s", start_data.get("stream_id"), source.config["zello_channel"])
+	# packets keep queueing while the target streams start
+	stream_ids = await asyncio.gather(*(target.start_stream(dict(send, channel=target.config["zello_channel"])) for target in targets))
+	streams = [(target, stream_id) for target, stream_id in zip(targets, stream_ids) if stream_id]
+	for target, stream_id in zip(targets, stream_ids):
+		if not stream_id:
+			LOG.warning("cannot relay to %s", target.config["zello_channel"])
+	try:
+		while True:
+			try:
+				received = await asyncio.wait_for(packets.get(), 1)
+			except asyncio.TimeoutError:
+				LOG.warning("timeout waiting for stream data")
+				return
 			if type(received) == bytes:
-				if received[0] == 1: # audio
-					stream_id = bytes_to_uint32(received[1:5])
-					packet_id = bytes_to_uint32(received[5:9])
-					data_length = len(received) - 9
-					data = received[9:]
-					# print(f"stream_from_zello: {stream_id}:{packet_id} data length: {data_length}")
-					audio = opuslib.api.decoder.decode(dec, data, data_length, zello_chunk, False, 1)
-					# print(f"stream_from_zello: audio length: {len(audio)}")
-					vol_adjust = config["audio_output_volume"] / config["audio_output_channels"]
-					np_audio = repeat(frombuffer(audio, dtype=short), config["audio_output_channels"]) * vol_adjust
-					if sample_rate != config["audio_output_sample_rate"]:
-						audio_out = librosa.resample(np_audio.astype(float32), orig_sr=sample_rate, target_sr=config["audio_output_sample_rate"]).astype(short)
-						audio_output_stream.write(audio_out.tobytes())
-					else:
-						audio_output_stream.write(np_audio.astype(short).toBytes())
-			else:
-				LOG.info("end of bytes stream")
-				if config["ptt_command_support"]:
-					run_ptt_command("PTT off", config["ptt_off_command"], config["ptt_off_delay"])
-				return # can only be an on_stream_stop if not binary
-		except Exception as ex:
-			LOG.error("exception: %s", ex)
-			if config["ptt_command_support"]:
-				run_ptt_command("PTT off", config["ptt_off_command"], config["ptt_off_delay"])
-			return
+				for target, stream_id in streams:
+					packet = bytearray(received)
+					HEADER.pack_into(packet, 0, 1, stream_id, 0)
+					await target.outbound.room()  # packets held during the handshake go out in a burst
+					target.send_binary(packet)
+			elif received.get("command") == "on_stream_stop":
+				return
+	finally:
+		for target, stream_id in streams:
+			target.stop_stream(stream_id)
+
+
+async def report_startup(sessions):
+	started = time.perf_counter()
+	for session in sessions:
+		await session.connected.wait()
+		startup.add("logon " + session.config["zello_channel"], time.perf_counter() - started)
+	startup.report()
+
+
+async def end_of_input(transmitting):
+	await transmitting
+	raise EndOfInput()
+
+
+async def run_bridge(config, audio_input_stream=None, audio_output_stream=None, udp_sock=None, profile_startup=False, input_blocks=None):
+	global processing
+	loop = asyncio.get_running_loop()
+	if config["tgid_channels"]:
+		routes = config["tgid_channels"]
+	elif config["tgid_in_stream"]:
+		routes = {config["tgid_to_play"]: config["zello_channels"]}
+	else:
+		routes = {None: config["zello_channels"]}
+	relay_channels = {channel for relay_from, relay_to in config["relays"] for channel in (relay_from, relay_to)}
+	# blocking websocket, audio device and UDP calls each hold a worker thread
+	connections = sum(len(channels) for channels in routes.values()) + len(relay_channels) + len(config["rx_channels"])
+	loop.set_default_executor(ThreadPoolExecutor(max_workers=4 + len(routes) + 2 * connections))
+	tasks = []
+	audio_ready = {tgid: asyncio.Event() for tgid in routes}
+	if udp_sock:
+		def notify(tgid):
+			loop.call_soon_threadsafe(audio_ready[tgid].set)
+		tasks.append(loop.run_in_executor(None, udp_rx, udp_sock, config, notify))
+	elif audio_input_stream:
+		# only UDP audio carries TGIDs, so there is a single route to capture for
+		capture_buffer = create_capture_buffer(config)
+		capture_ready = next(iter(audio_ready.values()))
+		tasks.append(loop.run_in_executor(None, capture_rx, audio_input_stream, config, capture_buffer, lambda: loop.call_soon_threadsafe(capture_ready.set)))
+	mixer = None
+	ptt = None
+	sessions = []
+	if audio_output_stream:
+		mixer = Mixer(
+			audio_output_stream,
+			int(config["audio_output_sample_rate"] * 0.02),
+			config["audio_output_channels"],
+			config["audio_output_volume"] / config["audio_output_channels"],
+			config["rx_duck_gain"],
+			sample_rate=config["audio_output_sample_rate"],
+		)
+		ptt = create_ptt_controller(config)
+	if not config["zello_work"]:
+		tasks.append(refresh_jwt(config))
+	archiver = Archiver(config["archive_dir"]) if config["archive_dir"] else None
+	if not (audio_input_stream or audio_output_stream or udp_sock or input_blocks):
+		routes = {}  # relaying only
+	for tgid, zello_channels in routes.items():
+		route_config = dict(config, zello_channel=zello_channels[0], zello_channels=zello_channels, route_tgid=tgid)
+		route_sessions = [ZelloSession(dict(route_config, zello_channel=channel), receive=mixer is not None) for channel in zello_channels]
+		frames = asyncio.Queue(maxsize=FRAME_QUEUE_SIZE)
+		resampler = StreamResampler(config["audio_input_sample_rate"], config["zello_sample_rate"])
+		sessions.extend(route_sessions)
+		tasks.extend(session.run() for session in route_sessions)
+		if input_blocks:
+			# the bridge stops once the file or stdin has been sent
+			tasks.append(end_of_input(transmit(route_config, route_sessions, frames, archiver, backpressure=config["input_pacing"] == "fast")))
+			tasks.append(file_frames(route_config, input_blocks, resampler, frames))
+		else:
+			tasks.append(transmit(route_config, route_sessions, frames, archiver))
+		if udp_sock:
+			tasks.append(buffered_frames(route_config, udp_buffers[tgid], resampler, frames, audio_ready[tgid]))
+		elif audio_input_stream:
+			tasks.append(buffered_frames(route_config, capture_buffer, resampler, frames, audio_ready[tgid]))
+		if mixer:
+			tasks.extend(receive(session.config, session, mixer, ptt, archiver) for session in route_sessions)
+	if mixer:
+		# channels that are only listened to
+		for channel in config["rx_channels"]:
+			if not any(session.config["zello_channel"] == channel for session in sessions):
+				session = ZelloSession(dict(config, zello_channel=channel, route_tgid=None))
+				sessions.append(session)
+				tasks.append(session.run())
+				tasks.append(receive(session.config, session, mixer, ptt, archiver))
+	relay_sessions = {}
+	for channel in sorted(relay_channels):
+		relay_sessions[channel] = ZelloSession(dict(config, zello_channel=channel), receive=any(channel == relay_from for relay_from, relay_to in config["relays"]))
+		sessions.append(relay_sessions[channel])
+		tasks.append(relay_sessions[channel].run())
+	for relay_from in sorted({relay_from for relay_from, relay_to in config["relays"]}):
+		targets = [relay_sessions[relay_to] for source, relay_to in config["relays"] if source == relay_from]
+		tasks.append(relay(relay_sessions[relay_from], targets))
+	if profile_startup:
+		tasks.append(report_startup(sessions))
+	if config["metrics_port"]:
+		start_http_server(metrics, config["metrics_port"])
+		LOG.info("serving metrics on port %d", config["metrics_port"])
+	if config["metrics_json_file"]:
+		tasks.append(dump_metrics(config["metrics_json_file"], config["metrics_interval"]))
+	try:
+		await asyncio.gather(*tasks)
+	finally:
+		processing = False
+		if ptt:
+			ptt.close()
+		if mixer:
+			mixer.close()
+		if archiver:
+			archiver.close()
 
 
 def main():
-	global udpdata,processing,udp_buffer_lock
-	stream_id = None
+	global processing,udp_buffers
 	processing = True
-	zello_ws = None
-	udpdata = b''
+	audio_input_stream = None
+	audio_output_stream = None
+	UDPSock = None
+	input_blocks = None
 
+	parser = argparse.ArgumentParser(description="Stream audio between a sound card or UDP port and a Zello channel")
+	parser.add_argument("--startup-profile", action="store_true", help="print the time spent in each startup phase once logged on")
+	parser.add_argument("--config", default="config.json", help="config file to use")
+	# set by supervisor.py for the bridges it runs
+	parser.add_argument("--metrics-json-file", help="override metrics_json_file")
+	parser.add_argument("--metrics-interval", type=float, help="override metrics_interval")
+	parser.add_argument("--cpus", help="comma separated CPU numbers to run on (Linux only)")
+	args = parser.parse_args()
+
+	if args.cpus:
+		if hasattr(os, "sched_setaffinity"):
+			os.sched_setaffinity(0, [int(cpu) for cpu in args.cpus.split(",")])
+		else:
+			LOG.warning("CPU pinning is not supported on this platform")
 	try:
-		config = get_config()
+		with startup.phase("read config"):
+			config = get_config(args.config)
 	except ConfigException as ex:
 		LOG.critical("configuration error: %s", ex)
 		sys.exit(1)
+	if args.metrics_json_file:
+		config["metrics_json_file"] = args.metrics_json_file
+	if args.metrics_interval:
+		config["metrics_interval"] = args.metrics_interval
 	
 	log_level = logging.getLevelName(config["logging_level"].upper())
 	LOG.setLevel(log_level)
 	
-	zello_chunk = int(config["zello_sample_rate"] * 0.06)
-	
 	if config["audio_source"] == "Sound Card":
 		LOG.debug("start PyAudio")
-		p = pyaudio.PyAudio()
+		with startup.phase("import PyAudio"):
+			import pyaudio
+		with startup.phase("start PyAudio"):
+			p = pyaudio.PyAudio()
 		LOG.debug("started PyAudio")
-		audio_input_stream, audio_output_stream = start_audio(config, p)
+		with startup.phase("open audio devices"):
+			audio_input_stream, audio_output_stream = start_audio(config, p)
 	elif config["audio_source"] == "UDP":
 		# Set up a UDP server to receive audio from trunk-recorder
-		UDPSock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-		UDPSock.settimeout(.5)
-		listen_addr = ("",config["udp_port"])
-		UDPSock.bind(listen_addr)
-		udp_rx_thread = Thread(target=udp_rx,args=(UDPSock,config))
-		udp_rx_thread.start()
-		udp_buffer_lock = Lock()
-	else:
-		LOG.warning("Invalid Audio Source")
-
-	enc = create_encoder(config)
+		with startup.phase("open UDP port"):
+			UDPSock = open_udp_socket(config)
+			udp_buffers = create_udp_buffers(config)
+	elif config["audio_source"] == "File":
+		input_blocks = file_blocks(playlist(config["audio_file"]), config["audio_input_sample_rate"], config["audio_input_channels"])
+	elif config["audio_source"] == "Stdin":
+		input_blocks = stream_blocks(open(sys.stdin.fileno(), "rb", buffering=0, closefd=False))
 
-	while processing:
-		try:
-			if config["audio_source"] == "Sound Card":
-				data = record_chunk(config, audio_input_stream, channel=config["in_channel_config"])
-			elif config["audio_source"] == "UDP":
-				data = get_udp_audio(config,seconds=0.06, channel=config["in_channel_config"])
-			else:
-				data = frombuffer(b'',dtype=short)
-			if len(data) > 0:
-				max_audio_level = max(abs(data))
-			else:
-				max_audio_level = 0
-				time.sleep(.06)
-			if len(data) > 0 and max_audio_level > config["audio_threshold"]: # Start sending to channel
-				print("Audio on")
-				if not zello_ws or not zello_ws.connected:
-					zello_ws = create_zello_connection(config)
-					if not zello_ws:
-						print("Cannot establish connection")
-						time.sleep(1)
-						continue
-				zello_ws.settimeout(1)
-				stream_id = start_stream(config, zello_ws)
-				if not stream_id:
-					print("Cannot start stream")
-					time.sleep(1)
-					continue
-				print("sending to stream_id " + str(stream_id))
-				packet_id = 0  # packet ID is only used in server to client - populate with zeros for client to server direction
-				quiet_samples = 0
-				timer = time.time()
-				while quiet_samples < (config["vox_silence_time"] * (1 / 0.06)):
-					if time.time() - timer > 30:
-						print("Timer break")
-						stop_stream(zello_ws, stream_id)
-						stream_id = start_stream(config, zello_ws)
-						if not stream_id:
-							print("Cannot start stream")
-							break
-						timer = time.time()
-					if len(data) > 0:
-						data2 = data.tobytes()
-						out = opuslib.api.encoder.encode(enc, data2, zello_chunk, len(data2) * 2)
-						send_data = bytearray(array([1]).astype(">u1").tobytes())
-						send_data = send_data + array([stream_id]).astype(">u4").tobytes()
-						send_data = send_data + array([packet_id]).astype(">u4").tobytes()
-						send_data = send_data + out
-						try:
-							nbytes = zello_ws.send_binary(send_data)
-							if nbytes == 0:
-								print("Binary send error")
-								break
-						except Exception as ex:
-							print(f"Zello error {ex}")
-							break
-					if config["audio_source"] == "Sound Card":
-						data = record_chunk(config, audio_input_stream, channel=config["in_channel_config"])
-					elif config["audio_source"] == "UDP":
-						data = get_udp_audio(config,seconds=0.06, channel=config["in_channel_config"])
-					else:
-						data = frombuffer(b'',dtype=short)
-					if len(data) > 0:
-						max_audio_level = max(abs(data))
-					else:
-						max_audio_level = 0
-						time.sleep(.06)
-					if len(data) == 0 or max_audio_level < config["audio_threshold"]:
-						quiet_samples = quiet_samples + 1
-					else:
-						quiet_samples = 0
-				print("Done sending audio")
-				stop_stream(zello_ws, stream_id)
-				stream_id = None
-			else: # Monitor channel for incoming traffic
-				if not zello_ws or not zello_ws.connected:
-					zello_ws = create_zello_connection(config)
-					if not zello_ws:
-						LOG.warning("cannot establish connection for incoming")
-						time.sleep(1)
-						continue
-				try:
-					zello_ws.settimeout(0.05)
-					result = zello_ws.recv()
-					LOG.debug("recv: %s", result)
-					data = json.loads(result)
-					if "command" in data and data["command"] == "on_stream_start" : # look for on_stream_start command to receive audio stream
-						zello_ws.settimeout(1)
-						stream_from_zello(config, zello_ws, audio_output_stream, data)
-				except Exception as ex:
-					pass
-		except KeyboardInterrupt:
-			LOG.error("keyboard interrupt caught")
-			if stream_id:
-				LOG.info("stop sending audio")
-				stop_stream(zello_ws, stream_id)
-				stream_id = None
-			processing = False
+	try:
+		asyncio.run(run_bridge(config, audio_input_stream, audio_output_stream, UDPSock, args.startup_profile, input_blocks))
+	except KeyboardInterrupt:
+		LOG.error("keyboard interrupt caught")
+	except EndOfInput:
+		LOG.info("end of audio input")
+	processing = False
 
 	LOG.info("terminating")
-	if zello_ws:
-		zello_ws.close()
 	if config["audio_source"] == "Sound Card":
 		audio_input_stream.close()
 		audio_output_stream.close()
 		p.terminate()
 	elif config["audio_source"] == "UDP":
-		time.sleep(1)
 		UDPSock.close()
 
 if __name__ == "__main__":